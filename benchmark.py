@@ -0,0 +1,297 @@
+"""Benchmark every codec path on the bundled images and on synthetic covers.
+
+Usage:
+
+    python benchmark.py --output results.json
+    python benchmark.py --sizes 0.1 1 12 --output new.json --compare results.json
+    python benchmark.py --startup
+
+Each case is timed over several runs and the fastest run is kept. Peak
+memory comes from tracemalloc, which sees Python and NumPy allocations but
+not the buffers Pillow allocates internally. When Numba is installed the
+merge, unmerge and text cases also run with the Numba backend, as the
+cases ending in _numba.
+
+--startup measures cold starts instead, each in a new interpreter: the
+imports of steganography.py and of the Streamlit utils, and a merge and
+an unmerge from the command line. It fails when one is over its budget in
+STARTUP_BUDGETS or imports one of LAZY_MODULES before it is needed.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'streamlit'))
+
+from steganography import Steganography  # noqa: E402
+from utils import utils  # noqa: E402
+
+SAMPLES = {
+    's1': ('res/s1/cover.jpg', 'res/s1/secret.jpg'),
+    's2': ('res/s2/gateway.jpg', 'res/s2/tajhotel.jpg'),
+    's3': ('res/s3/lake.jpg', 'res/s3/mountain.jpg'),
+}
+
+DEFAULT_SIZES = (0.1, 1, 5)
+
+KEY = 'benchmark'
+
+NOISE_SECONDS = 0.001
+
+# Cold-start budgets in seconds. The imports must stay far below the time of
+# the small jobs our shell loops run, and merge/unmerge of a small pair
+# should cost little more than starting Python.
+STARTUP_BUDGETS = {
+    'import steganography': 0.5,
+    'import utils': 0.5,
+    'merge': 1.0,
+    'unmerge': 1.0,
+}
+
+# Slow imports only the features using them may pull in: metrics, the Numba
+# backend, text encryption
+LAZY_MODULES = ('skimage', 'scipy', 'numba', 'cryptography')
+
+
+def measure(func, repeat):
+    """Run func repeat times and return the best time, the mean and the peak memory."""
+    times = []
+    tracemalloc.start()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), sum(times) / len(times), peak
+
+
+def synthetic_pair(megapixels, directory):
+    """Write a random 4:3 cover of the given size and a secret half its size."""
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(megapixels * 1e6 / width)
+    rng = np.random.default_rng(0)
+    paths = []
+    for name, (w, h) in (('cover', (width, height)), ('secret', (width // 2, height // 2))):
+        path = os.path.join(directory, f'{name}-{megapixels}mp.png')
+        Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8)).save(path, compress_level=1)
+        paths.append(path)
+    return paths
+
+
+def cases(cover_path, secret_path):
+    """Return (name, function) pairs for every codec path on one cover/secret pair."""
+    steganography = Steganography()
+    cover, secret = Image.open(cover_path), Image.open(secret_path)
+    cover.load()
+    secret.load()
+    merged = steganography.merge(cover, secret)
+
+    message = 'x' * min(utils.calculate_image_max_bytes(cover_path), 10_000)
+    _, encoded = utils.encode(cover_path, message, KEY)
+    encoded_image = utils.encode_images(cover, secret)
+
+    results = [
+        ('merge', lambda: steganography.merge(cover, secret)),
+        ('unmerge', lambda: steganography.unmerge(merged)),
+        ('unmerge_compare', lambda: steganography.unmerge(merged, compare=secret_path)),
+        ('text_encode', lambda: utils.encode(cover_path, message, KEY)),
+        ('text_decode', lambda: utils.decode(encoded, KEY)),
+        ('encode_images', lambda: utils.encode_images(cover, secret)),
+        ('decode_image', lambda: utils.decode_image(encoded_image)),
+        ('calculate_image_max_bytes', lambda: utils.calculate_image_max_bytes(cover_path)),
+        ('png_export_array', lambda: utils.generateDownloadableImage(encoded)),
+        ('png_export_pil', lambda: utils.generateDownloadableImageFromPilImage(encoded_image)),
+    ]
+    if Steganography(backend='numba').backend == 'numba':
+        results += numba_cases(cover, secret, merged, cover_path, message, encoded)
+    return results
+
+
+def numba_cases(cover, secret, merged, cover_path, message, encoded):
+    """Return the cases of the Numba backend, after compiling its kernels."""
+    steganography = Steganography(backend='numba')
+
+    def with_numba(func):
+        def run_case():
+            utils.set_backend('numba')
+            try:
+                return func()
+            finally:
+                utils.set_backend('numpy')
+        return run_case
+
+    results = [
+        ('merge_numba', lambda: steganography.merge(cover, secret)),
+        ('unmerge_numba', lambda: steganography.unmerge(merged)),
+        ('text_encode_numba', with_numba(lambda: utils.encode(cover_path, message, KEY))),
+        ('text_decode_numba', with_numba(lambda: utils.decode(encoded, KEY))),
+    ]
+    # Keep the JIT compilation out of the timings
+    for _, func in results:
+        func()
+    return results
+
+
+def run(sizes, repeat, only):
+    """Run the benchmarks and return the result records."""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        pairs = [(name, os.path.join(ROOT, cover), os.path.join(ROOT, secret))
+                 for name, (cover, secret) in SAMPLES.items()]
+        pairs += [(f'synthetic-{size}mp', *synthetic_pair(size, directory)) for size in sizes]
+
+        for image_name, cover_path, secret_path in pairs:
+            with Image.open(cover_path) as cover:
+                megapixels = cover.size[0] * cover.size[1] / 1e6
+            for case, func in cases(cover_path, secret_path):
+                if only and not any(pattern in case for pattern in only):
+                    continue
+                # The comparison metrics are far slower than everything else
+                with contextlib.redirect_stdout(io.StringIO()):
+                    best, mean, peak = measure(func, 1 if case == 'unmerge_compare' else repeat)
+                results.append({'case': case, 'image': image_name, 'megapixels': round(megapixels, 3),
+                                'seconds': best, 'mean_seconds': mean, 'peak_bytes': peak})
+                print(f'{case:26} {image_name:18} {megapixels:7.2f} MP {best * 1000:10.2f} ms '
+                      f'{peak / 1e6:9.1f} MB', flush=True)
+    return results
+
+
+def import_time(code, cwd):
+    """Import in a new interpreter with -X importtime.
+
+    :return: The cumulative seconds of the top-level imports and the names
+        of all the modules imported.
+    """
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=cwd,
+                            capture_output=True, text=True, check=True).stderr
+    modules, total = set(), 0
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        if name.strip() == 'site':
+            # Everything so far was the interpreter starting up
+            modules, total = set(), 0
+        elif not name.startswith('  '):
+            # Top-level imports are not indented; their times include their dependencies
+            total += int(cumulative) / 1e6
+    return total, modules
+
+
+def startup(repeat):
+    """Measure the cold starts against STARTUP_BUDGETS and return the result records."""
+    with tempfile.TemporaryDirectory() as directory:
+        cover, secret = (os.path.join(ROOT, path) for path in SAMPLES['s3'])
+        merged = os.path.join(directory, 'merged.png')
+        commands = {
+            'merge': ['merge', '--coverImage', cover, '--secretImage', secret, '--output', merged],
+            'unmerge': ['unmerge', '--image', merged, '--output', os.path.join(directory, 'unmerged.png')],
+        }
+        results = []
+        for name, budget in STARTUP_BUDGETS.items():
+            times, imported = [], set()
+            for _ in range(repeat):
+                if name.startswith('import'):
+                    code, cwd = (('import steganography', ROOT) if name == 'import steganography'
+                                 else ('from utils import utils', os.path.join(ROOT, 'streamlit')))
+                    seconds, modules = import_time(code, cwd)
+                    imported |= modules
+                else:
+                    start = time.perf_counter()
+                    subprocess.run([sys.executable, os.path.join(ROOT, 'steganography.py')] + commands[name],
+                                   cwd=directory, capture_output=True, check=True)
+                    seconds = time.perf_counter() - start
+                times.append(seconds)
+            eager = sorted({module.split('.')[0] for module in imported} & set(LAZY_MODULES))
+            result = {'case': name, 'seconds': min(times), 'budget_seconds': budget, 'eager_imports': eager}
+            results.append(result)
+            status = 'OVER BUDGET' if result['seconds'] > budget else 'ok'
+            print(f'{name:26} {result["seconds"] * 1000:10.1f} ms  budget {budget * 1000:6.0f} ms  {status}'
+                  + (f'  imports {", ".join(eager)}' if eager else ''), flush=True)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Print the change of every case against a baseline and return the regressions."""
+    previous = {(r['case'], r['image']): r for r in baseline['results']}
+    regressions = []
+    print()
+    print(f'Compared with {baseline.get("revision") or "baseline"}:')
+    for result in results:
+        old = previous.get((result['case'], result['image']))
+        if not old:
+            continue
+        ratio = result['seconds'] / old['seconds'] if old['seconds'] else float('inf')
+        marker = ''
+        # Sub-millisecond differences are timer noise
+        if ratio > 1 + threshold and result['seconds'] - old['seconds'] > NOISE_SECONDS:
+            marker = '  REGRESSION'
+            regressions.append(result)
+        print(f'{result["case"]:26} {result["image"]:18} {ratio:6.2f}x time{marker}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Steganography benchmarks')
+    parser.add_argument('--sizes', type=float, nargs='*', default=DEFAULT_SIZES,
+                        help='Synthetic cover sizes in megapixels, like 0.1 1 5 12 24 50')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case, the fastest is kept')
+    parser.add_argument('--cases', nargs='*', help='Only run the cases whose name contains one of these')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare with the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Slowdown ratio above which a case counts as a regression')
+    parser.add_argument('--startup', action='store_true',
+                        help='Check the cold-start times against their budgets instead')
+    args = parser.parse_args()
+
+    if args.startup:
+        results = startup(args.repeat)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump({'revision': git_revision(), 'python': platform.python_version(),
+                           'platform': platform.platform(), 'startup': results}, file, indent=2)
+        if any(r['seconds'] > r['budget_seconds'] or r['eager_imports'] for r in results):
+            sys.exit(1)
+        return
+
+    results = run(args.sizes, args.repeat, args.cases)
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            if compare(results, json.load(file), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Numba JIT kernels for Steganography(backend='numba') and the Streamlit
+utils after set_backend('numba').
+
+Each kernel makes a single pass over the pixels, in parallel over the rows
+(or bytes), and writes straight into its output without NumPy temporaries.
+Importing this module raises ImportError when Numba is not installed.
+"""
+import numba
+
+
+@numba.njit(parallel=True, cache=True)
+def merge_kernel(cover, secret, out, cover_table, secret_table):
+    """Same result as Steganography._merge_arrays, written into out."""
+    height, width, channels = cover.shape
+    secret_height, secret_width = secret.shape[0], secret.shape[1]
+    for i in numba.prange(height):
+        for j in range(width):
+            for c in range(channels):
+                value = cover_table[cover[i, j, c]]
+                if i < secret_height and j < secret_width:
+                    value |= secret_table[secret[i, j, c]]
+                out[i, j, c] = value
+
+
+@numba.njit(parallel=True, cache=True)
+def unmerge_kernel(array, out, table):
+    """Same result as Steganography._unmerge_array, written into out."""
+    height, width, channels = array.shape
+    for i in numba.prange(height):
+        for j in range(width):
+            for c in range(channels):
+                out[i, j, c] = table[array[i, j, c]]
+
+
+@numba.njit(parallel=True, cache=True)
+def embed_kernel(channels, data):
+    """Write the bits of `data` into the LSBs of the first len(data) * 8 channel values."""
+    # one byte per iteration, its 8 bits into 8 channel values, MSB first
+    for i in numba.prange(len(data)):
+        byte = data[i]
+        for bit in range(8):
+            channels[i * 8 + bit] = (channels[i * 8 + bit] & 0xFE) | ((byte >> (7 - bit)) & 1)
+
+
+@numba.njit(parallel=True, cache=True)
+def extract_kernel(channels, out):
+    """Pack the LSBs of the first len(out) * 8 channel values into `out`."""
+    for i in numba.prange(len(out)):
+        byte = 0
+        for bit in range(8):
+            byte = (byte << 1) | (channels[i * 8 + bit] & 1)
+        out[i] = byte
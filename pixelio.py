@@ -0,0 +1,372 @@
+import io
+import json
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG color type -> (PIL mode, channels) for the 8-bit types we can stream
+PNG_COLOR_TYPES = {0: ('L', 1), 2: ('RGB', 3), 4: ('LA', 2), 6: ('RGBA', 4)}
+
+
+def _png_chunk(chunk_type, data):
+    """Build a PNG chunk with its length and CRC."""
+    return (struct.pack('>I', len(data)) + chunk_type + data
+            + struct.pack('>I', zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+
+def _read_png_chunks(file):
+    """Yield (type, data) for every chunk of a PNG file, after its signature."""
+    while True:
+        header = file.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack('>I4s', header)
+        data = file.read(length)
+        file.read(4)  # CRC
+        yield chunk_type, data
+        if chunk_type == b'IEND':
+            return
+
+
+class StripReader:
+    """Read an image as a sequence of fixed-height uint8 RGB row strips.
+
+    8-bit non-interlaced PNG files are decompressed incrementally and raw
+    .npy/PPM files are memory-mapped, so only one strip is held in memory
+    at a time. Other formats are decoded once by Pillow and then sliced
+    into strips.
+    """
+
+    def __init__(self, path, strip_height=256):
+        """
+        :param path: The image path.
+        :param strip_height: The number of rows per strip.
+        """
+        self.path = path
+        self.strip_height = strip_height
+        # Text metadata, like Image.info for PNG tEXt chunks
+        self.info = {}
+        self._file = open(path, 'rb')
+        self._chunks = None
+        self._pixels = None
+        self._png = self._read_png_header()
+        if self._png is None and is_raw(path):
+            self._file.close()
+            self._pixels = open_pixels(path)
+            self.size = self._pixels.shape[1], self._pixels.shape[0]
+            self.info = read_text(path)
+        elif self._png is None:
+            self._file.close()
+            self._image = Image.open(path)
+            self.size = self._image.size
+            self.info = {k: v for k, v in self._image.info.items() if isinstance(v, str)}
+            self.info.update(read_text(path))
+        else:
+            self.size = self._png['size']
+
+    def _read_png_header(self):
+        """Return the IHDR fields if the file is a PNG we can stream, else None.
+
+        The chunks before the image data are read as well, to fill self.info.
+        """
+        if self._file.read(8) != PNG_SIGNATURE:
+            return None
+        self._chunks = _read_png_chunks(self._file)
+        chunk_type, ihdr = next(self._chunks)
+        if chunk_type != b'IHDR':
+            return None
+        width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', ihdr)
+        if bit_depth != 8 or interlace or color_type not in PNG_COLOR_TYPES:
+            return None
+
+        first_data = None
+        for chunk_type, data in self._chunks:
+            if chunk_type == b'tEXt':
+                self._add_text(data)
+            elif chunk_type == b'IDAT':
+                first_data = data
+                break
+        return {'size': (width, height), 'ihdr': ihdr, 'color_type': color_type, 'first_data': first_data}
+
+    def _add_text(self, data):
+        key, _, value = data.partition(b'\x00')
+        self.info[key.decode('latin-1')] = value.decode('latin-1')
+
+    def _read_trailing_text(self):
+        """Add the tEXt chunks after the image data to self.info, like PngStripWriter.add_text writes."""
+        for chunk_type, data in self._chunks:
+            if chunk_type == b'tEXt':
+                self._add_text(data)
+
+    def read_trailing_text(self):
+        """Skip the image data not read yet and add the tEXt chunks after it to self.info.
+
+        For a caller that stops before the last strip. The chunks are read
+        but not decompressed. Only PNG files have trailing text.
+        """
+        if self._png is not None:
+            self._read_trailing_text()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __iter__(self):
+        if self._pixels is not None:
+            return self._iter_raw()
+        if self._png is None:
+            return self._iter_pillow()
+        return self._iter_png()
+
+    def _iter_raw(self):
+        for top in range(0, self.size[1], self.strip_height):
+            yield np.array(self._pixels[top:top + self.strip_height])
+
+    def _iter_pillow(self):
+        width, height = self.size
+        for top in range(0, height, self.strip_height):
+            strip = self._image.crop((0, top, width, min(top + self.strip_height, height)))
+            yield np.asarray(strip.convert('RGB'), dtype=np.uint8)
+
+    def _iter_png(self):
+        width, height = self.size
+        mode, channels = PNG_COLOR_TYPES[self._png['color_type']]
+        # Every scanline starts with its filter type byte
+        stride = width * channels + 1
+        previous = bytes(stride - 1)
+        pending = b''
+        rows_done = 0
+
+        for data in self._iter_png_data(self.strip_height * stride):
+            pending += data
+            while rows_done < height:
+                rows = min(self.strip_height, height - rows_done)
+                if len(pending) < rows * stride:
+                    break
+                strip = self._unfilter(pending[:rows * stride], previous, mode)
+                pending = pending[rows * stride:]
+                previous = strip[-1].tobytes()
+                rows_done += rows
+                if rows_done == height:
+                    # All the pixels are decoded: the rest of the file only holds chunks after them
+                    self._read_trailing_text()
+                yield _as_rgb(strip, mode)
+
+        if rows_done < height:
+            raise ValueError(f'{self.path} is truncated')
+
+    def _iter_png_data(self, max_length):
+        """Yield the decompressed image data in pieces of at most max_length bytes."""
+        decompressor = zlib.decompressobj()
+
+        def idat_chunks():
+            if self._png['first_data'] is not None:
+                yield self._png['first_data']
+            for chunk_type, data in self._chunks:
+                if chunk_type == b'IDAT':
+                    yield data
+
+        for data in idat_chunks():
+            while data:
+                yield decompressor.decompress(data, max_length)
+                data = decompressor.unconsumed_tail
+        yield decompressor.flush()
+
+    def _unfilter(self, raw_rows, previous, mode):
+        """Undo the PNG filters of raw scanlines, given the row above them.
+
+        Pillow does the work: the scanlines are wrapped in a stored
+        (uncompressed) PNG whose first row is the previous, already
+        unfiltered row, so Up/Average/Paeth filters see the right data.
+        """
+        width = self.size[0]
+        rows = len(raw_rows) // (len(previous) + 1)
+        ihdr = struct.pack('>II', width, rows + 1) + self._png['ihdr'][8:]
+        png = (PNG_SIGNATURE + _png_chunk(b'IHDR', ihdr)
+               + _png_chunk(b'IDAT', zlib.compress(b'\x00' + previous + raw_rows, 0))
+               + _png_chunk(b'IEND', b''))
+        return np.asarray(Image.open(io.BytesIO(png)), dtype=np.uint8)[1:]
+
+
+def _as_rgb(strip, mode):
+    """Convert a decoded strip in the given PIL mode to a uint8 RGB array."""
+    if mode == 'RGB':
+        return strip
+    return np.asarray(Image.fromarray(strip, mode).convert('RGB'), dtype=np.uint8)
+
+
+class PngStripWriter:
+    """Write an RGB PNG incrementally, one strip of rows at a time."""
+
+    def __init__(self, path, size, compress_level=6, text=None):
+        """
+        :param path: The output path.
+        :param size: The (width, height) of the whole image.
+        :param compress_level: The zlib compression level, 0-9.
+        :param text: A dict of tEXt chunks to write, like PngInfo.add_text.
+        """
+        self.path = path
+        self.size = size
+        self.rows_written = 0
+        self._trailing_text = {}
+        self._compressor = zlib.compressobj(compress_level)
+        self._file = open(path, 'wb')
+        width, height = size
+        self._file.write(PNG_SIGNATURE)
+        self._file.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        for key, value in (text or {}).items():
+            self._file.write(_png_chunk(b'tEXt', key.encode('latin-1') + b'\x00' + value.encode('latin-1')))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+    def write(self, strip):
+        """Append a uint8 array of shape (rows, width, 3) to the image."""
+        rows = strip.shape[0]
+        flat = strip.reshape(rows, -1)
+        # Sub filter: each byte minus the same channel of the pixel to its left
+        filtered = np.empty((rows, flat.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:4] = flat[:, :3]
+        np.subtract(flat[:, 3:], flat[:, :-3], out=filtered[:, 4:])
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._file.write(_png_chunk(b'IDAT', data))
+        self.rows_written += rows
+
+    def add_text(self, key, value):
+        """Add a tEXt chunk after the image data, for a value only known once the rows are written."""
+        self._trailing_text[key] = value
+
+    def close(self):
+        if self.rows_written != self.size[1]:
+            self._file.close()
+            raise ValueError(f'Expected {self.size[1]} rows, got {self.rows_written}')
+        self._file.write(_png_chunk(b'IDAT', self._compressor.flush()))
+        for key, value in self._trailing_text.items():
+            self._file.write(_png_chunk(b'tEXt', key.encode('latin-1') + b'\x00' + value.encode('latin-1')))
+        self._file.write(_png_chunk(b'IEND', b''))
+        self._file.close()
+
+
+# Raw formats that can be memory-mapped: .npy arrays and binary PPM (P6)
+RAW_EXTENSIONS = ('.npy', '.ppm')
+
+
+def is_raw(path):
+    """Whether path has the extension of a format open_pixels can map."""
+    return path.lower().endswith(RAW_EXTENSIONS)
+
+
+def _read_ppm_header(file, comments=None):
+    """Return the (width, height) and data offset of a binary 8-bit PPM file.
+
+    :param comments: A list receiving the text of the header's comment lines.
+    """
+    head = file.read(4096)
+    tokens, position = [], 0
+    while len(tokens) < 4:
+        while position < len(head) and head[position:position + 1].isspace():
+            position += 1
+        if head[position:position + 1] == b'#':
+            end = head.index(b'\n', position)
+            if comments is not None:
+                comments.append(head[position + 1:end].decode('latin-1').strip())
+            position = end
+            continue
+        end = position
+        while end < len(head) and not head[end:end + 1].isspace():
+            end += 1
+        if end == position:
+            raise ValueError(f'{file.name} has an invalid PPM header')
+        tokens.append(head[position:end])
+        position = end
+    magic, width, height, maxval = tokens
+    if magic != b'P6' or maxval != b'255':
+        raise ValueError(f'{file.name} is not a binary 8-bit PPM file')
+    # A single whitespace byte separates the header from the pixels
+    return (int(width), int(height)), position + 1
+
+
+def open_pixels(path):
+    """Map a .npy or PPM file of RGB pixels read-only, without reading it.
+
+    :return: A uint8 array of shape (height, width, 3) backed by the file.
+    """
+    if path.lower().endswith('.npy'):
+        array = np.load(path, mmap_mode='r')
+        if array.dtype != np.uint8 or array.ndim != 3 or array.shape[2] != 3:
+            raise ValueError(f'{path} should hold a uint8 array of shape (height, width, 3)')
+        return array
+    with open(path, 'rb') as file:
+        (width, height), offset = _read_ppm_header(file)
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(height, width, 3))
+
+
+def create_pixels(path, shape, text=None):
+    """Create a .npy or PPM file and map its pixels for writing.
+
+    :param path: The output path.
+    :param shape: The (height, width, 3) shape of the pixels.
+    :param text: A dict of text to record, like PngInfo.add_text. PPM files
+        keep it in comment lines of their header; .npy files cannot.
+    :return: A writable uint8 array backed by the file; flush it when done.
+    """
+    if path.lower().endswith('.npy'):
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape)
+    comments = ''.join(f'# {key}: {value}\n' for key, value in (text or {}).items())
+    header = f'P6\n{comments}{shape[1]} {shape[0]}\n255\n'.encode('latin-1')
+    with open(path, 'wb') as file:
+        file.write(header)
+        file.truncate(len(header) + shape[0] * shape[1] * 3)
+    return np.memmap(path, dtype=np.uint8, mode='r+', offset=len(header), shape=shape)
+
+
+# Formats whose files can hold text next to the pixels: PNG tEXt chunks, the
+# TIFF ImageDescription tag (as JSON) and PPM header comments
+TEXT_EXTENSIONS = ('.png', '.tif', '.tiff', '.ppm')
+
+TIFF_DESCRIPTION_TAG = 270
+
+
+def read_text(path):
+    """Return the text recorded in a TIFF description (see tiff_description) or in PPM comments by create_pixels.
+
+    PNG text is read by Pillow and StripReader instead. Other files give {}.
+    """
+    extension = path.lower().rsplit('.', 1)[-1]
+    if extension == 'ppm':
+        comments = []
+        with open(path, 'rb') as file:
+            _read_ppm_header(file, comments)
+        return dict(comment.split(': ', 1) for comment in comments if ': ' in comment)
+    if extension in ('tif', 'tiff'):
+        with Image.open(path) as image:
+            description = image.tag_v2.get(TIFF_DESCRIPTION_TAG)
+        try:
+            text = json.loads(description) if description else {}
+        except ValueError:
+            return {}
+        return text if isinstance(text, dict) else {}
+    return {}
+
+
+def tiff_description(text):
+    """Return the ImageDescription to save with a TIFF file so read_text finds text."""
+    return json.dumps(text, sort_keys=True)
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+import numpy as np
+import PIL
+
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'steganography')
+
+# Eviction limits applied after every store
+DEFAULT_MAX_BYTES = 1 << 30
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+
+HASH_CHUNK_SIZE = 1 << 20
+
+# The modules whose code decides the output bytes
+SOURCES = ('steganography.py', 'pixelio.py', 'numba_kernels.py')
+
+
+@lru_cache(maxsize=None)
+def tool_version():
+    """Return a digest of the encoder sources and of the NumPy and Pillow versions.
+
+    Any change to them gives new cache keys, so stale results are never
+    served after an upgrade; they age out instead.
+    """
+    digest = hashlib.sha256(f'numpy {np.__version__} pillow {PIL.__version__}'.encode())
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in SOURCES:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                digest.update(file.read())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """An on-disk cache of output files, keyed by a hash of everything that produced them.
+
+    An entry is a copy of an output file named after its key. Its
+    modification time is the last time it was stored or used, which drives
+    the least-recently-used eviction.
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        """
+        :param directory: The cache directory, created if needed.
+        :param max_bytes: The total size entries are pruned down to after a store.
+        :param max_age: The seconds since its last use after which an entry is pruned.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def key(self, operation, inputs, params):
+        """Hash the operation, its parameters, the tool version and the bytes of the input files.
+
+        :param operation: The operation name, like 'merge'.
+        :param inputs: The input file paths, in order.
+        :param params: A dict of the JSON-serializable parameters changing the output.
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps([tool_version(), operation, params], sort_keys=True).encode())
+        for path in inputs:
+            file_digest = hashlib.sha256()
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+                    file_digest.update(chunk)
+            digest.update(file_digest.digest())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key, output):
+        """Copy the entry of key to output if there is one.
+
+        :return: Whether the entry was found.
+        """
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, output)
+        except FileNotFoundError:
+            return False
+        os.utime(path)
+        return True
+
+    def put(self, key, output):
+        """Store a copy of the output file under key, then prune the cache."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Copy then rename, so a reader never sees a partial entry
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        os.close(descriptor)
+        try:
+            shutil.copyfile(output, temporary)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+        self.prune()
+
+    @contextmanager
+    def cached(self, operation, inputs, params, output):
+        """Serve output from the cache, or store it once the block has written it.
+
+        The block receives whether output was served from the cache, and
+        should write output only if it was not:
+
+            with cache.cached('merge', [cover, secret], {'bits': 4}, output) as hit:
+                if not hit:
+                    ...
+
+        The output extension is part of the key, since it decides the format.
+        """
+        params = dict(params, extension=os.path.splitext(output)[1].lower())
+        key = self.key(operation, inputs, params)
+        if self.get(key, output):
+            yield True
+            return
+        yield False
+        self.put(key, output)
+
+    def entries(self):
+        """Return (path, size, last use) for every entry, least recently used first."""
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for prefix in os.listdir(self.directory):
+            directory = os.path.join(self.directory, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    status = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((path, status.st_size, status.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def stats(self):
+        """Return the number of entries, their total size and the ages of the oldest and newest."""
+        entries = self.entries()
+        now = time.time()
+        return {
+            'directory': self.directory,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'oldest_seconds': now - entries[0][2] if entries else None,
+            'newest_seconds': now - entries[-1][2] if entries else None,
+        }
+
+    def prune(self, max_bytes=None, max_age=None):
+        """Remove the entries unused for max_age, then the least recently used down to max_bytes.
+
+        :param max_bytes: The size limit, self.max_bytes if not given.
+        :param max_age: The age limit in seconds, self.max_age if not given.
+        :return: The number of entries removed and their total size.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        max_age = self.max_age if max_age is None else max_age
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - max_age
+        removed, removed_bytes = 0, 0
+        for path, size, last_use in entries:
+            if last_use >= cutoff and total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+            removed_bytes += size
+        return removed, removed_bytes
@@ -0,0 +1,430 @@
+"""Local HTTP API for the encoders, backed by a pool of warm worker processes.
+
+Start it with ``python steganography.py serve``. Every endpoint but
+/metrics takes a POST whose body is the raw file contents:
+
+    POST /merge?cover_size=N&bits=4   cover (first N bytes) then secret -> PNG
+    POST /unmerge?bits=4              encoded image -> PNG
+    POST /encode-text?image_size=N    image (first N bytes) then UTF-8 text -> PNG
+    POST /decode-text                 encoded image -> UTF-8 text
+    POST /capacity                    image -> JSON
+    GET  /metrics                     Prometheus text format
+
+The text endpoints read the key from the X-Steganography-Key header.
+/unmerge and /decode-text answer with an X-Steganography-Status header,
+verified or unverified (no checksum recorded); /unmerge also sends a
+corrupt secret with the status corrupt, while /decode-text refuses a
+corrupt image with 422 and a wrong key with 403.
+Request bodies are spooled to temporary files while they arrive and
+results are sent back from a file in chunks, so the server process never
+holds a whole image. Requests beyond max_pending are refused with 503.
+"""
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from multiprocessing import get_context
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'streamlit'))
+
+from steganography import STATUS_KEY, Steganography, open_image, save_image  # noqa: E402
+from utils import utils  # noqa: E402
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+COPY_CHUNK_SIZE = 1 << 16
+
+# The per-request spool directories, cut out of error messages so responses
+# never show server paths
+TEMP_DIRECTORY = re.compile(re.escape(os.path.join(tempfile.gettempdir(), 'steganography-')) + r'[^/\s]*/')
+
+KEY_HEADER = 'X-Steganography-Key'
+STATUS_HEADER = 'X-Steganography-Status'
+
+ENDPOINTS = ('merge', 'unmerge', 'encode-text', 'decode-text', 'capacity')
+
+
+class HttpError(Exception):
+    """An error answered with the given HTTP status and message."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# Worker side: these run in the pool processes and exchange file paths, so
+# only short strings cross the process boundary.
+
+_backend = 'numpy'
+
+
+def _warm_up(backend):
+    """Initialize a worker process: import everything and compile the kernels."""
+    global _backend
+    _backend = Steganography(backend=backend).backend
+    utils.set_backend(backend)
+    pixels = Image.new('RGB', (16, 16))
+    steganography = Steganography(backend=_backend)
+    steganography.unmerge(steganography.merge(pixels, pixels))
+    png = BytesIO()
+    pixels.save(png, format='PNG')
+    utils.decode(utils.encode(png, '', 'warm-up')[1], 'warm-up')
+
+
+def _ping():
+    return os.getpid()
+
+
+def _merge(cover_path, secret_path, output_path, bits):
+    merged = Steganography(backend=_backend).merge(open_image(cover_path), open_image(secret_path), bits=bits)
+    save_image(merged, output_path, compress_level=1)
+
+
+def _unmerge(image_path, output_path, bits):
+    decoded = Steganography(backend=_backend).unmerge(open_image(image_path), bits=bits)
+    save_image(decoded, output_path, compress_level=1)
+    return decoded.info[STATUS_KEY]
+
+
+def _encode_text(image_path, text_path, output_path, key):
+    with open(text_path, 'rb') as file:
+        text = file.read().decode('utf-8')
+    _, encoded = utils.encode(image_path, text, key)
+    save_image(Image.fromarray(encoded), output_path, compress_level=1)
+
+
+def _decode_text(image_path, key):
+    pixels = np.asarray(open_image(image_path).convert('RGB'))
+    return utils.decode_with_status(pixels, key)
+
+
+def _capacity(image_path):
+    with Image.open(image_path) as image:
+        width, height = image.size
+    return {'width': width, 'height': height, 'text_bytes': utils.calculate_image_max_bytes(image_path)}
+
+
+# Server side
+
+class Histogram:
+    """A latency histogram with cumulative buckets, like a Prometheus histogram."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[index] += 1
+
+    def lines(self, name, labels):
+        for bound, count in zip(self.buckets, self.counts):
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {count}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f'{name}_sum{{{labels}}} {self.sum:.6f}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+class Metrics:
+    """Request latencies per endpoint and counters, shared by the handler threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {endpoint: Histogram() for endpoint in ENDPOINTS}
+        self.responses = {}
+        self.rejected = 0
+        self.pending = 0
+
+    def start(self):
+        with self._lock:
+            self.pending += 1
+
+    def finish(self, endpoint, status, seconds):
+        with self._lock:
+            self.pending -= 1
+        self.record(endpoint, status, seconds)
+
+    def reject(self, endpoint):
+        """Count a request refused because the queue is full, without a latency."""
+        self.record(endpoint, 503, None)
+
+    def record(self, endpoint, status, seconds):
+        # Unknown paths share one label, so clients can't grow the metrics
+        endpoint = endpoint if endpoint in self.latency else 'other'
+        with self._lock:
+            if seconds is None:
+                self.rejected += 1
+            elif endpoint in self.latency:
+                self.latency[endpoint].observe(seconds)
+            self.responses[endpoint, status] = self.responses.get((endpoint, status), 0) + 1
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            lines = ['# TYPE steganography_request_seconds histogram']
+            for endpoint, histogram in self.latency.items():
+                lines += histogram.lines('steganography_request_seconds', f'endpoint="{endpoint}"')
+            lines.append('# TYPE steganography_responses_total counter')
+            for (endpoint, status), count in sorted(self.responses.items()):
+                lines.append(f'steganography_responses_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+            lines += ['# TYPE steganography_rejected_total counter',
+                      f'steganography_rejected_total {self.rejected}',
+                      '# TYPE steganography_pending_requests gauge',
+                      f'steganography_pending_requests {self.pending}']
+        return '\n'.join(lines) + '\n'
+
+
+class StegServer(ThreadingHTTPServer):
+    """A threaded HTTP server handing the work to a process pool."""
+
+    daemon_threads = True
+
+    def __init__(self, address, workers=1, max_pending=None, max_body=256 << 20, backend='numpy'):
+        """
+        :param address: The (host, port) to listen on.
+        :param workers: The number of worker processes.
+        :param max_pending: The number of requests running or waiting for a
+            worker; more are refused with 503. Four per worker if not given.
+        :param max_body: The largest accepted request body, in bytes.
+        :param backend: The pixel kernels of the workers, 'numpy' or 'numba'.
+        """
+        super().__init__(address, RequestHandler)
+        self.workers = workers
+        self.max_body = max_body
+        self.metrics = Metrics()
+        self.slots = threading.BoundedSemaphore(max_pending or 4 * workers)
+        # spawn: forking the threaded server would copy its locks mid-use
+        self.pool = ProcessPoolExecutor(workers, mp_context=get_context('spawn'),
+                                        initializer=_warm_up, initargs=(backend,))
+        # Start every worker now rather than on the first requests
+        for future in [self.pool.submit(_ping) for _ in range(workers)]:
+            future.result()
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(cancel_futures=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server_version = 'steganography'
+    # HTTP/1.1: persistent connections, and answers to Expect: 100-continue
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_expect_100(self):
+        # Refuse a missing or oversized body before the client sends it
+        if self.command != 'POST':
+            return super().handle_expect_100()
+        try:
+            self._content_length()
+        except (HttpError, ValueError) as error:
+            status = getattr(error, 'status', 400)
+            self.server.metrics.record(urlsplit(self.path).path.strip('/'), status, 0.0)
+            self.close_connection = True
+            self._send_error(status, str(error))
+            return False
+        return super().handle_expect_100()
+
+    def do_GET(self):
+        self._body_read = 0
+        path = urlsplit(self.path).path
+        if path == '/metrics':
+            self._send_bytes(200, self.server.metrics.render().encode(), 'text/plain; version=0.0.4')
+        elif path == '/health':
+            self._send_bytes(200, b'ok\n', 'text/plain')
+        else:
+            self._send_error(404, f'No such endpoint: {path}')
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        endpoint = url.path.strip('/')
+        start = time.perf_counter()
+        status = 200
+        self._body_read = 0
+        self._responded = False
+        if not self.server.slots.acquire(blocking=False):
+            self.server.metrics.reject(endpoint)
+            self._send_error(503, 'Too many pending requests', {'Retry-After': '1'})
+            return
+        self.server.metrics.start()
+        try:
+            with tempfile.TemporaryDirectory(prefix='steganography-') as directory:
+                self._handle(endpoint, parse_qs(url.query), directory)
+        except Exception as error:
+            if self._responded:
+                # Writing the response failed, most likely because the client
+                # went away: there is no one left to send an error to
+                self.close_connection = True
+            elif isinstance(error, HttpError):
+                status = error.status
+                self._send_error(status, str(error))
+            else:
+                status = 400 if isinstance(error, (ValueError, OSError, Image.DecompressionBombError)) else 500
+                self._send_error(status, _error_message(error))
+        finally:
+            self.server.slots.release()
+            self.server.metrics.finish(endpoint, status, time.perf_counter() - start)
+
+    def _handle(self, endpoint, query, directory):
+        pool = self.server.pool
+        output = os.path.join(directory, 'output.png')
+        if endpoint == 'merge':
+            cover, secret = self._spool_body(directory, _int_param(query, 'cover_size'))
+            pool.submit(_merge, cover, secret, output, _int_param(query, 'bits', 4)).result()
+            self._send_file(output, 'image/png')
+        elif endpoint == 'unmerge':
+            image, = self._spool_body(directory)
+            status = pool.submit(_unmerge, image, output, _int_param(query, 'bits', None)).result()
+            self._send_file(output, 'image/png', {STATUS_HEADER: status})
+        elif endpoint == 'encode-text':
+            image, text = self._spool_body(directory, _int_param(query, 'image_size'))
+            pool.submit(_encode_text, image, text, output, self._key()).result()
+            self._send_file(output, 'image/png')
+        elif endpoint == 'decode-text':
+            image, = self._spool_body(directory)
+            status, text = pool.submit(_decode_text, image, self._key()).result()
+            if status == utils.CORRUPT:
+                raise HttpError(422, 'The image does not match its checksum')
+            if status == utils.WRONG_KEY:
+                raise HttpError(403, 'Wrong key')
+            self._send_bytes(200, text.encode('utf-8'), 'text/plain; charset=utf-8', {STATUS_HEADER: status})
+        elif endpoint == 'capacity':
+            image, = self._spool_body(directory)
+            capacity = pool.submit(_capacity, image).result()
+            self._send_bytes(200, json.dumps(capacity).encode(), 'application/json')
+        else:
+            raise HttpError(404, f'No such endpoint: /{endpoint}')
+
+    def _key(self):
+        key = self.headers.get(KEY_HEADER)
+        if not key:
+            raise HttpError(400, f'The {KEY_HEADER} header is required')
+        return key
+
+    def _content_length(self):
+        length = self.headers.get('Content-Length')
+        if length is None:
+            raise HttpError(411, 'Content-Length is required')
+        length = int(length)
+        if length > self.server.max_body:
+            raise HttpError(413, f'The body is larger than {self.server.max_body} bytes')
+        return length
+
+    def _spool_body(self, directory, first_size=None):
+        """Copy the request body to files as it arrives and return their paths.
+
+        :param directory: The directory receiving the files.
+        :param first_size: Split the body after this many bytes into two files.
+        """
+        length = self._content_length()
+        sizes = [length] if first_size is None else [first_size, length - first_size]
+        if min(sizes) < 0:
+            raise HttpError(400, 'The part size is larger than the body')
+        paths = []
+        for index, size in enumerate(sizes):
+            path = os.path.join(directory, f'input-{index}')
+            with open(path, 'wb') as file:
+                while size:
+                    chunk = self.rfile.read(min(size, COPY_CHUNK_SIZE))
+                    if not chunk:
+                        raise HttpError(400, 'The body is shorter than Content-Length')
+                    file.write(chunk)
+                    size -= len(chunk)
+                    self._body_read += len(chunk)
+            paths.append(path)
+        return paths
+
+    def _discard_body(self):
+        """Read and drop the rest of the request body, so the connection can take the next request.
+
+        A body without a valid length, larger than max_body or cut short
+        can't be skipped: the connection is closed after the response instead.
+        """
+        try:
+            length = self._content_length() - self._body_read
+        except (HttpError, ValueError):
+            self.close_connection = True
+            return
+        while length > 0:
+            chunk = self.rfile.read(min(length, COPY_CHUNK_SIZE))
+            if not chunk:
+                self.close_connection = True
+                return
+            length -= len(chunk)
+            self._body_read += len(chunk)
+
+    def _send_file(self, path, content_type, headers=None):
+        self._responded = True
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        with open(path, 'rb') as file:
+            shutil.copyfileobj(file, self.wfile, COPY_CHUNK_SIZE)
+
+    def _send_bytes(self, status, body, content_type, headers=None):
+        self._responded = True
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message, headers=None):
+        self._discard_body()
+        if self.close_connection:
+            headers = dict(headers or {}, Connection='close')
+        self._send_bytes(status, json.dumps({'error': message}).encode() + b'\n', 'application/json', headers)
+
+
+def _error_message(error):
+    """Return the error type and message with the server's temporary paths removed."""
+    return f'{type(error).__name__}: {TEMP_DIRECTORY.sub("", str(error))}'
+
+
+def _int_param(query, name, default=...):
+    """Return an integer query parameter, raising a 400 error if it is missing or invalid."""
+    if name not in query:
+        if default is ...:
+            raise HttpError(400, f'The {name} query parameter is required')
+        return default
+    try:
+        return int(query[name][0])
+    except ValueError:
+        raise HttpError(400, f'{name} should be an integer')
+
+
+def serve(host='127.0.0.1', port=8000, workers=1, max_pending=None, max_body=256 << 20, backend='numpy'):
+    """Run the HTTP API until interrupted. See StegServer for the parameters."""
+    server = StegServer((host, port), workers=workers, max_pending=max_pending, max_body=max_body,
+                        backend=backend)
+    print(f'Serving on http://{host}:{server.server_address[1]} with {workers} worker(s)', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,325 @@
+"""Statistical detection of LSB steganography, for scanning image corpora.
+
+Run it with ``python steganography.py detect``. Every image gets three
+scores computed over whole arrays, with no per-pixel Python code:
+
+- chi_square: the Westfeld-Pfitzmann pairs-of-values test. Writing
+  random bits into the lowest bit equalizes the counts of the values 2k
+  and 2k+1, from 0 (natural histogram) to 1 (equalized). A smooth
+  histogram has equal neighbouring counts without any message, so the
+  counts of 2k-1 and 2k, which embedding does not equalize, serve as a
+  control. It is tested over the first 1/64, 1/16, 1/4 and all of the
+  channel values, since the text encoder fills the image from the top,
+  with a Bonferroni correction for testing four prefixes.
+- rs: the embedding rate estimated by Fridrich's RS analysis, the share
+  of channel values whose lowest bit carries a message.
+- low_nibble: the fingerprint of merge. In a photo, the higher a bit
+  plane, the more neighbouring bits agree. merge puts the top bit of the
+  secret in plane bits - 1, which then agrees more than the cover's plane
+  above it. The score grows with that inversion, over the planes 0-4
+  (merges with 1 to 4 bits).
+
+lsb_entropy, the entropy of the 2x2 patterns of the lowest bit plane
+scaled to 0-1, is reported but not scored: camera noise and embedded
+bits both keep it close to 1, and a constant plane, where it is 0, holds
+nothing.
+
+It also looks for the signatures of this project's own encoders: the
+headers of merge (STGI), embed_file (STGF) and the Streamlit text encoder
+(GGST), the terminator of legacy text payloads and the PNG text keys.
+A signature makes the score 1; otherwise the score is the highest of
+chi_square, rs and low_nibble.
+"""
+import csv
+import json
+import math
+import os
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'streamlit'))
+
+from steganography import (FILE_HEADER_FORMAT, FILE_HEADER_MAGIC, FILE_HEADER_SIZE, IMAGE_EXTENSIONS,  # noqa: E402
+                           TEXT_KEYS, _extract_bits, _read_image_header, open_image)
+from utils import utils  # noqa: E402
+
+# Columns of the report, in order
+FIELDS = ('path', 'width', 'height', 'score', 'chi_square', 'rs', 'low_nibble', 'lsb_entropy', 'signatures', 'error')
+
+# Prefixes of the channel values tested by chi_square
+CHI_SQUARE_PREFIXES = (1 / 64, 1 / 16, 1 / 4, 1)
+CHI_SQUARE_MIN_EXPECTED = 5
+
+# RS analysis looks at groups of 4 neighbouring values of a row, flipping the middle two
+RS_GROUP = 4
+
+# RS analysis and low_nibble run on evenly spaced rows holding about this many
+# values, which is plenty for a stable estimate and bounds the time on large images
+RS_MAX_VALUES = 1 << 21
+
+# The bit planes low_nibble compares, each with the one above it
+LOW_NIBBLE_PLANES = 4
+
+# The plane inversion scoring 1 in low_nibble. Merging photos gives 0.25
+# or more; photos, graphics and noise give 0 or less.
+LOW_NIBBLE_FULL_SCORE = 0.25
+
+
+def _chi2_survival(x, df):
+    """Return P(X > x) for a chi-square variable with df degrees of freedom.
+
+    The Wilson-Hilferty approximation: (X / df) ** (1/3) is close to normal.
+    It is accurate to a few thousandths for the 20 to 127 degrees of
+    freedom seen here, and spares importing scipy.
+    """
+    mean = 1 - 2 / (9 * df)
+    z = ((x / df) ** (1 / 3) - mean) / math.sqrt(2 / (9 * df))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def _pairs_p_value(histogram):
+    """Return the p-value of the counts of each pair of values of a histogram being equal.
+
+    :param histogram: The counts of consecutive values, pairing the first
+        with the second, the third with the fourth...
+    :return: The p-value, or None with too few values to test.
+    """
+    expected = (histogram[0::2] + histogram[1::2]) / 2
+    # The chi-square approximation needs a few expected values per pair
+    used = expected >= CHI_SQUARE_MIN_EXPECTED
+    if used.sum() < 2:
+        return None
+    statistic = float((((histogram[0::2] - expected)[used]) ** 2 / expected[used]).sum())
+    return _chi2_survival(statistic, int(used.sum()) - 1)
+
+
+def chi_square(channels):
+    """Return the pairs-of-values score, the highest over the prefixes of the channel values.
+
+    Each prefix scores the p-value of 2k and 2k+1 having equal counts,
+    Bonferroni corrected for the number of prefixes, times one minus the
+    p-value of 2k-1 and 2k having equal counts.
+
+    :param channels: The flat uint8 channel values, in row order.
+    """
+    bounds = sorted({max(1, int(len(channels) * fraction)) for fraction in CHI_SQUARE_PREFIXES})
+    histogram = np.zeros(256, dtype=np.int64)
+    start, best = 0, 0.0
+    # One pass: each prefix adds the histogram of the values since the previous one
+    for end in bounds:
+        histogram += np.bincount(channels[start:end], minlength=256)
+        start = end
+        p_value, control = _pairs_p_value(histogram), _pairs_p_value(histogram[1:-1])
+        if p_value is None:
+            continue
+        corrected = max(0.0, 1 - len(bounds) * (1 - p_value))
+        best = max(best, corrected * (1 - (control or 0.0)))
+    return best
+
+
+def _sample_rows(array):
+    """Return evenly spaced rows of an array holding about RS_MAX_VALUES values (a view)."""
+    return array[::max(1, array.size // RS_MAX_VALUES)]
+
+
+def _rs_groups(array):
+    """Return the 4 values of the groups of neighbouring values of the same row and channel.
+
+    :return: Four int16 arrays (views, no copies): the first, second, third
+        and fourth value of every group.
+    """
+    width = array.shape[1] - array.shape[1] % RS_GROUP
+    rows = np.asarray(_sample_rows(array)[:, :width], dtype=np.int16)
+    return tuple(rows[:, column::RS_GROUP] for column in range(RS_GROUP))
+
+
+def _flip_negative(values):
+    """Swap 2k-1 and 2k, the negative of the LSB flip."""
+    return ((values + 1) ^ 1) - 1
+
+
+def _regular_singular(first, second, third, fourth):
+    """Return R - S for the mask and for the negative mask, flipping the middle two values.
+
+    R (S) is the share of groups that get less (more) smooth when the
+    masked values are flipped: 2k <-> 2k+1 for the mask, 2k-1 <-> 2k for the
+    negative mask. Smoothness is the sum of the absolute differences of
+    neighbouring values.
+    """
+    before = np.abs(second - first) + np.abs(third - second) + np.abs(fourth - third)
+    differences = []
+    for flip in (np.bitwise_xor(second, 1), np.bitwise_xor(third, 1)), (_flip_negative(second), _flip_negative(third)):
+        after = np.abs(flip[0] - first) + np.abs(flip[1] - flip[0]) + np.abs(fourth - flip[1])
+        differences.append(np.count_nonzero(after > before) - np.count_nonzero(after < before))
+    return [difference / before.size for difference in differences]
+
+
+def rs_analysis(array):
+    """Estimate the share of channel values carrying a message in their lowest bit.
+
+    :param array: A uint8 RGB array.
+    :return: The estimated embedding rate, from 0 to 1.
+    """
+    groups = _rs_groups(array)
+    if not groups[0].size:
+        return 0.0
+    d0, dn0 = _regular_singular(*groups)
+    # The same with every lowest bit flipped, as if the embedding rate were 1 - p/2
+    d1, dn1 = _regular_singular(*(values ^ 1 for values in groups))
+    a, b, c = 2 * (d1 + d0), dn0 - dn1 - d1 - 3 * d0, d0 - dn0
+    if abs(a) < 1e-12:
+        roots = [-c / b] if abs(b) > 1e-12 else []
+    else:
+        discriminant = b * b - 4 * a * c
+        if discriminant < 0:
+            return 0.0
+        roots = [(-b + sign * math.sqrt(discriminant)) / (2 * a) for sign in (1, -1)]
+    if not roots:
+        return 0.0
+    z = min(roots, key=abs)
+    if z == 0.5:
+        return 1.0
+    return min(1.0, max(0.0, z / (z - 0.5)))
+
+
+def _plane_agreement(plane):
+    """Return how much more often horizontal neighbours of a bit plane agree than chance.
+
+    Cohen's kappa: 0 for independent bits, 1 when neighbours always agree.
+    A constant plane agrees by chance alone and gets 0.
+    """
+    ones = np.count_nonzero(plane) / plane.size
+    chance = ones * ones + (1 - ones) * (1 - ones)
+    if chance == 1:
+        return 0.0
+    agree = np.count_nonzero(plane[:, 1:] == plane[:, :-1]) / plane[:, 1:].size
+    return (agree - chance) / (1 - chance)
+
+
+def low_nibble(array):
+    """Score the bit plane inversion merge leaves in the low bits, from 0 to 1.
+
+    :param array: A uint8 RGB array.
+    """
+    rows = _sample_rows(array)
+    if rows.shape[1] < 2:
+        return 0.0
+    agreements = [_plane_agreement(rows >> plane & 1) for plane in range(LOW_NIBBLE_PLANES + 1)]
+    inversion = max(agreements[plane] - agreements[plane + 1] for plane in range(LOW_NIBBLE_PLANES))
+    return min(1.0, max(0.0, inversion / LOW_NIBBLE_FULL_SCORE))
+
+
+def lsb_entropy(array):
+    """Return the entropy of the 2x2 patterns of the lowest bit plane, from 0 to 1."""
+    height, width = array.shape[0] & ~1, array.shape[1] & ~1
+    plane = array[:height, :width] & 1
+    patterns = (plane[0::2, 0::2] << 3 | plane[0::2, 1::2] << 2 | plane[1::2, 0::2] << 1 | plane[1::2, 1::2])
+    counts = np.bincount(patterns.reshape(-1), minlength=16)
+    if not counts.sum():
+        return 1.0
+    probabilities = counts[counts > 0] / counts.sum()
+    # A constant plane would give -0.0
+    return max(0.0, float(-(probabilities * np.log2(probabilities)).sum() / 4))
+
+
+def signatures(array, info):
+    """Return the names of the signatures of this project's encoders found in an image.
+
+    :param array: A uint8 RGB array.
+    :param info: The image info, holding the PNG text chunks.
+    """
+    found = [key for key in TEXT_KEYS if key in info]
+    channels = array.reshape(-1)
+    if _read_image_header(array) is not None:
+        found.append('merge-header')
+    if len(channels) >= FILE_HEADER_SIZE * 8:
+        if struct.unpack(FILE_HEADER_FORMAT, _extract_bits(channels, FILE_HEADER_SIZE, 1)[0])[0] == FILE_HEADER_MAGIC:
+            found.append('file-header')
+    if len(channels) >= utils.HEADER_SIZE * 8 and utils.read_header(array) is not None:
+        found.append('text-header')
+    # Legacy text payloads end with stop_at, somewhere in the lowest bits
+    if utils.stop_at.encode('ascii') in np.packbits(channels[:len(channels) & ~7] & 1).tobytes():
+        found.append('text-terminator')
+    return found
+
+
+def analyze(path):
+    """Run every test on one image file.
+
+    :return: A report row: a dict keyed by FIELDS. Errors are reported in
+        the row instead of being raised.
+    """
+    row = dict.fromkeys(FIELDS)
+    row['path'] = path
+    try:
+        image = open_image(path)
+        image.load()
+        array = np.ascontiguousarray(np.asarray(image.convert('RGB'), dtype=np.uint8))
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        row['error'] = str(error)
+        return row
+    row['height'], row['width'] = array.shape[:2]
+    row['chi_square'] = round(chi_square(array.reshape(-1)), 4)
+    row['rs'] = round(rs_analysis(array), 4)
+    row['low_nibble'] = round(low_nibble(array), 4)
+    row['lsb_entropy'] = round(lsb_entropy(array), 4)
+    row['signatures'] = signatures(array, image.info)
+    row['score'] = 1.0 if row['signatures'] else max(row['chi_square'], row['rs'], row['low_nibble'])
+    return row
+
+
+def find_images(paths):
+    """Expand directories into the image files under them, recursively and sorted."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, subdirectories, names in os.walk(path):
+            subdirectories.sort()
+            for name in sorted(names):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(directory, name)
+
+
+def scan(paths, processes=None):
+    """Analyze image files on a process pool.
+
+    :param paths: Image files and directories.
+    :param processes: The number of worker processes (default: all cores).
+        With 1, the files are analyzed in this process.
+    :return: An iterator of report rows, in the order of the files.
+    """
+    files = list(find_images(paths))
+    if processes == 1 or len(files) < 2:
+        yield from map(analyze, files)
+        return
+    workers = processes or os.cpu_count()
+    with ProcessPoolExecutor(workers) as executor:
+        # Several files per task keep the inter-process traffic small for small images
+        yield from executor.map(analyze, files, chunksize=max(1, min(16, len(files) // (4 * workers))))
+
+
+class ReportWriter:
+    """Write report rows as CSV (with a header row) or JSONL, one row at a time."""
+
+    def __init__(self, file, format='csv'):
+        """
+        :param file: A text file open for writing.
+        :param format: 'csv' or 'jsonl'.
+        """
+        self.file = file
+        self.format = format
+        if format == 'csv':
+            self._writer = csv.DictWriter(file, FIELDS)
+            self._writer.writeheader()
+
+    def write(self, row):
+        if self.format == 'jsonl':
+            self.file.write(json.dumps(row) + '\n')
+        else:
+            self._writer.writerow(dict(row, signatures=';'.join(row['signatures'] or ())))
+        self.file.flush()
@@ -1,18 +1,501 @@
 import argparse
+import cProfile
+import csv
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from queue import Queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
 import numpy as np
-from skimage.metrics import structural_similarity as ssim
-from skimage.metrics import peak_signal_noise_ratio as psnr
-from skimage.metrics import mean_squared_error as mse
-from PIL import Image
+from PIL import Image, PngImagePlugin
+
+from pixelio import (TEXT_EXTENSIONS, StripReader, PngStripWriter, create_pixels, is_raw, open_pixels, read_text,
+                     tiff_description)
+from resultcache import DEFAULT_DIRECTORY as DEFAULT_CACHE_DIRECTORY, ResultCache
+
 
 import warnings
 warnings.filterwarnings("ignore")
 
 
+@lru_cache(maxsize=None)
+def _numba_kernels():
+    """The numba_kernels module, or None without Numba.
+
+    Like skimage for the metrics, Numba is imported on first use: either
+    takes longer to import than a small merge takes to run.
+    """
+    try:
+        import numba_kernels
+    except ImportError:
+        return None
+    return numba_kernels
+
+
+class Stats:
+    """Wall time spent in named stages (load, convert, embed...), accumulated across calls.
+
+    The counters are updated under a lock, since the threads of a Pipeline
+    share the stats of their process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.pixels = 0
+        self.bytes_written = 0
+
+    @contextmanager
+    def stage(self, name):
+        """Time the body of a with statement as part of the given stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def count(self, pixels=0, bytes_written=0):
+        """Add processed pixels and written bytes to the totals."""
+        with self._lock:
+            self.pixels += pixels
+            self.bytes_written += bytes_written
+
+    def iterate(self, name, iterable):
+        """Yield the items of iterable, timing the production of each one as the given stage."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def to_dict(self, total_seconds):
+        """Return the stats as a JSON-serializable dict."""
+        with self._lock:
+            return {
+                'total_seconds': total_seconds,
+                'stages': {name: {'seconds': seconds, 'pixels_per_second': self.pixels / seconds if seconds else None}
+                           for name, seconds in self.stages.items()},
+                'pixels': self.pixels,
+                'pixels_per_second': self.pixels / total_seconds if total_seconds else None,
+                'bytes_written': self.bytes_written,
+            }
+
+
+# Stage timings of the current process, dumped by --stats-json
+stats = Stats()
+
+
+# The PNG text key recording how many bits per channel hold the secret
+BITS_KEY = 'steganography-bits'
+
+
+def _check_bits(bits):
+    if not 1 <= bits <= 7:
+        raise ValueError('bits should be between 1 and 7!')
+
+
+@lru_cache(maxsize=None)
+def _merge_tables(bits):
+    """Return the lookup tables keeping the high bits of a cover value and
+    moving the high bits of a secret value down, for `bits` secret bits."""
+    _check_bits(bits)
+    values = np.arange(256, dtype=np.uint8)
+    return values & (0xFF << bits & 0xFF), values >> (8 - bits)
+
+
+@lru_cache(maxsize=None)
+def _unmerge_table(bits):
+    """Return the lookup table moving the low `bits` bits of a value up."""
+    _check_bits(bits)
+    values = np.arange(256, dtype=np.uint8)
+    return (values & ((1 << bits) - 1)) << (8 - bits)
+
+
+def _recorded_bits(info):
+    """Return the bits per channel recorded in image info, defaulting to 4."""
+    return int(info.get(BITS_KEY, 4))
+
+
+# PNG text key recording the 'WxH' size of the secret before merge fitted it to the cover
+SECRET_SIZE_KEY = 'steganography-secret-size'
+
+# PNG text key recording 'WxH:crc32' for the secret as merged: its size and the
+# CRC32 of the pixels unmerge should give back. Unlike the image header it is
+# also there when the secret fills the cover.
+CHECKSUM_KEY = 'steganography-checksum'
+
+# PNG text key recording the 'WxH' size of the secret as merged, written by
+# merge_stream before the pixels: its CHECKSUM_KEY can only follow them
+MERGED_SIZE_KEY = 'steganography-merged-size'
+
+# The text keys save_image keeps in PNG files
+TEXT_KEYS = (BITS_KEY, SECRET_SIZE_KEY, CHECKSUM_KEY, MERGED_SIZE_KEY)
+
+# Image info key set by unmerge to the outcome of checking the secret against its checksum
+STATUS_KEY = 'steganography-status'
+VERIFIED = 'verified'
+CORRUPT = 'corrupt'
+UNVERIFIED = 'unverified'
+# Only for the text of the Streamlit app: intact, but the key does not decrypt it
+WRONG_KEY = 'wrong-key'
+
+FIT_MODES = ('pad', 'crop', 'resize')
+
+
+def prepare_secret(secret, cover_size, fit='pad'):
+    """Fit a secret image to the size of a cover before merging it.
+
+    Merging fills the part of the cover the secret leaves with BLACK_PIXEL,
+    so a smaller secret is always kept as it is. A larger one is handled
+    according to fit:
+
+    - 'pad' refuses it with a ValueError.
+    - 'crop' keeps its top-left corner.
+    - 'resize' scales it down to fit the cover, keeping its aspect ratio.
+      A JPEG secret is decoded straight at a reduced DCT scale (1/2, 1/4
+      or 1/8) with Image.draft, so an oversized photo is never decoded at
+      full resolution.
+
+    :param secret: The secret PIL image, ideally not loaded yet.
+    :param cover_size: The (width, height) of the cover.
+    :param fit: 'pad', 'crop' or 'resize'.
+    :return: An RGB image no larger than the cover, and the original
+        (width, height) of the secret.
+    """
+    if fit not in FIT_MODES:
+        raise ValueError(f'fit should be one of {", ".join(FIT_MODES)}!')
+    width, height = secret.size
+    cover_width, cover_height = cover_size
+
+    if width > cover_width or height > cover_height:
+        if fit == 'pad':
+            raise ValueError('Image 2 should be smaller than Image 1!')
+        if fit == 'crop':
+            with stats.stage('load'):
+                secret = secret.crop((0, 0, min(width, cover_width), min(height, cover_height)))
+        else:
+            scale = min(cover_width / width, cover_height / height)
+            size = max(1, int(width * scale)), max(1, int(height * scale))
+            with stats.stage('load'):
+                # At least twice the final size, so the resampling below still has detail to average
+                secret.draft('RGB', (size[0] * 2, size[1] * 2))
+                secret.load()
+            with stats.stage('resize'):
+                secret = secret.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+    if secret.mode != 'RGB':
+        secret = secret.convert('RGB')
+    return secret, (width, height)
+
+
+# Output formats that would alter the low bits of the pixels, and so the payload
+LOSSY_EXTENSIONS = ('.jpg', '.jpeg', '.jpe', '.jfif', '.webp', '.gif', '.jp2', '.j2k', '.heic', '.avif')
+
+
+def check_lossless(path):
+    """Raise a ValueError if path has the extension of a lossy image format."""
+    if path.lower().endswith(LOSSY_EXTENSIONS):
+        raise ValueError(f'{path}: lossy formats would destroy the hidden data, use PNG, BMP, PPM, TIFF or .npy')
+
+
+def open_image(path):
+    """Open an image file, or a .npy array of RGB pixels as written by save_image.
+
+    The text save_image records in TIFF and PPM files is added to the image info.
+    """
+    if path.lower().endswith('.npy'):
+        with stats.stage('load'):
+            return Image.fromarray(np.load(path, mmap_mode='r'), 'RGB')
+    image = Image.open(path)
+    image.info.update(read_text(path))
+    return image
+
+
+def _check_recordable(path, bits, cover_shape, secret_shape):
+    """Make sure an output keeps what unmerge needs of a merge.
+
+    With no room for the image header, only the text of PNG, TIFF and PPM
+    files records the bits and checksum. Losing the bits would silently
+    decode garbage, so other formats are refused unless bits is the default;
+    losing only the checksum is a warning.
+
+    :param path: The output path.
+    :param bits: The bits per channel of the merge.
+    :param cover_shape: The (height, width) of the cover.
+    :param secret_shape: The (height, width) of the secret.
+    """
+    if _header_fits(cover_shape, secret_shape) or path.lower().endswith(TEXT_EXTENSIONS):
+        return
+    if bits != 4:
+        raise ValueError(f'{path}: this format cannot record --bits {bits} when the secret fills the cover, '
+                         'use PNG, TIFF or PPM')
+    print(f'Warning: {path} cannot record the checksum of a secret filling the cover, '
+          'use PNG, TIFF or PPM to verify it later', file=sys.stderr)
+
+
+def save_image(image, path, compress_level=None, optimize=False):
+    """Save an image, picking the format from the path's extension.
+
+    PNG, TIFF and PPM files keep the text merge records (bits per channel,
+    secret size, checksum): in tEXt chunks, the TIFF ImageDescription or
+    PPM comments. TIFF files are written uncompressed and PPM and .npy
+    files hold the raw RGB array, which are the fastest formats for
+    intermediate outputs. Merged images that could not be unmerged from
+    the output are refused, see _check_recordable.
+
+    :param image: The image to save.
+    :param path: The output path.
+    :param compress_level: The PNG zlib level, 0 (fastest) to 9 (smallest).
+        Pillow's default, 6, if not given.
+    :param optimize: Let Pillow search for the smallest PNG encoding (slow).
+    """
+    extension = os.path.splitext(path)[1].lower()
+    text = {key: image.info[key] for key in TEXT_KEYS if key in image.info}
+    recorded = _parse_checksum(text)
+    if recorded is not None:
+        _check_recordable(path, _recorded_bits(text), image.size[::-1], recorded[1::-1])
+    params = {}
+    if extension == '.png':
+        if text:
+            pnginfo = PngImagePlugin.PngInfo()
+            for key, value in text.items():
+                pnginfo.add_text(key, value)
+            params['pnginfo'] = pnginfo
+        if compress_level is not None:
+            params['compress_level'] = compress_level
+        params['optimize'] = optimize
+    elif extension in ('.tif', '.tiff'):
+        params['compression'] = 'raw'
+        if text:
+            params['description'] = tiff_description(text)
+
+    with stats.stage('save'):
+        if extension == '.npy':
+            np.save(path, np.asarray(image.convert('RGB')))
+        elif extension == '.ppm':
+            pixels = np.asarray(image.convert('RGB'))
+            output = create_pixels(path, pixels.shape, text)
+            output[...] = pixels
+            output.flush()
+            del output
+        else:
+            image.save(path, **params)
+    stats.count(bytes_written=os.path.getsize(path))
+
+
+# Header of an embedded file, written with 1 bit per channel value before
+# the payload: magic, format version, bits per channel, payload length. From
+# version 2 it is followed by FILE_CHECKSUM_FORMAT, the CRC32 of the payload.
+FILE_HEADER_FORMAT = '>4sBBQ'
+FILE_HEADER_MAGIC = b'STGF'
+FILE_HEADER_VERSION = 2
+FILE_HEADER_SIZE = struct.calcsize(FILE_HEADER_FORMAT)
+FILE_CHECKSUM_FORMAT = '>I'
+FILE_CHECKSUM_SIZE = struct.calcsize(FILE_CHECKSUM_FORMAT)
+
+# Payload bytes per channel bit embedded or extracted at a time
+FILE_CHUNK_SIZE = 1 << 17
+
+
+def _embed_bits(channels, data, bits):
+    """Write the bits of data into the low `bits` bits of the channel values.
+
+    :param channels: A flat uint8 array, modified in place.
+    :param data: The bytes to write. If len(data) * 8 is not a multiple of
+        bits, the last value is padded with zero bits.
+    :param bits: The number of low bits of each value receiving data.
+    :return: The number of channel values written.
+    """
+    data_bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    count = -(-len(data_bits) // bits)
+    if count > len(channels):
+        raise ValueError('The payload does not fit in the cover image!')
+    if bits > 1:
+        # Regroup the bits by channel value, most significant first
+        if len(data_bits) % bits:
+            data_bits = np.concatenate([data_bits, np.zeros(count * bits - len(data_bits), dtype=np.uint8)])
+        groups = data_bits.reshape(count, bits)
+        data_bits = groups[:, 0].copy()
+        for column in range(1, bits):
+            data_bits <<= 1
+            data_bits |= groups[:, column]
+    target = channels[:count]
+    target &= 0xFF << bits & 0xFF
+    target |= data_bits
+    return count
+
+
+def _extract_bits(channels, length, bits):
+    """Read length bytes from the low `bits` bits of the channel values.
+
+    :return: The bytes and the number of channel values read.
+    """
+    count = -(-length * 8 // bits)
+    if count > len(channels):
+        raise ValueError('The image is too small for the announced payload!')
+    values = channels[:count]
+    if bits == 1:
+        data_bits = values & 1
+    else:
+        data_bits = np.empty((count, bits), dtype=np.uint8)
+        for column in range(bits):
+            np.right_shift(values, bits - 1 - column, out=data_bits[:, column])
+        data_bits &= 1
+        data_bits = data_bits.reshape(-1)
+    return np.packbits(data_bits[:length * 8]).tobytes(), count
+
+
+# Header of a merged image: magic, format version, bits per channel, the
+# secret's width and height and, from version 2, the CRC32 of the secret as
+# unmerge gives it back. It is written with 1 bit per channel value into the
+# last IMAGE_HEADER_PIXELS pixels of the bottom row, when those pixels are
+# padding around the secret, so unmerge can extract the secret's region only.
+IMAGE_HEADER_FORMAT = '>4sBBIII'
+IMAGE_HEADER_MAGIC = b'STGI'
+IMAGE_HEADER_VERSION = 2
+IMAGE_HEADER_SIZE = struct.calcsize(IMAGE_HEADER_FORMAT)
+IMAGE_HEADER_PIXELS = -(-IMAGE_HEADER_SIZE * 8 // 3)
+
+# Version 1 headers, without the checksum, are still read
+IMAGE_HEADER_V1_FORMAT = '>4sBBII'
+IMAGE_HEADER_V1_SIZE = struct.calcsize(IMAGE_HEADER_V1_FORMAT)
+IMAGE_HEADER_V1_PIXELS = -(-IMAGE_HEADER_V1_SIZE * 8 // 3)
+
+
+def secret_checksum(secret, bits, checksum=0):
+    """Return the CRC32 of the secret pixels as unmerge gives them back: their high `bits` bits.
+
+    :param secret: The uint8 RGB secret array, or a strip of its rows.
+    :param bits: The number of bits per channel holding the secret.
+    :param checksum: The CRC32 of the previous rows, to continue from.
+    """
+    return zlib.crc32(np.bitwise_and(secret, 0xFF << (8 - bits) & 0xFF), checksum)
+
+
+def _format_checksum(secret_shape, checksum):
+    """Return the CHECKSUM_KEY value for a secret of shape (height, width)."""
+    return f'{secret_shape[1]}x{secret_shape[0]}:{checksum:08x}'
+
+
+def _parse_checksum(info):
+    """Return the (width, height, checksum) recorded under CHECKSUM_KEY in image info, or None."""
+    try:
+        size, checksum = info[CHECKSUM_KEY].split(':')
+        width, height = size.split('x')
+        return int(width), int(height), int(checksum, 16)
+    except (KeyError, ValueError):
+        return None
+
+
+def _parse_merged_size(info):
+    """Return the (width, height) recorded under MERGED_SIZE_KEY in image info, or None."""
+    try:
+        width, height = info[MERGED_SIZE_KEY].split('x')
+        return int(width), int(height)
+    except (KeyError, ValueError):
+        return None
+
+
+def _header_fits(shape, secret_shape):
+    """Whether the image header fits in the padding of a (height, width) cover around a secret."""
+    height, width = shape[:2]
+    secret_height, secret_width = secret_shape[:2]
+    return width >= IMAGE_HEADER_PIXELS and (secret_height < height or secret_width <= width - IMAGE_HEADER_PIXELS)
+
+
+def _write_image_header(merged, secret_shape, bits, checksum, shape=None):
+    """Record the secret size, bits and checksum in a merged uint8 RGB array, in place.
+
+    Nothing is written when the secret reaches the bottom-right corner, as
+    there is no padding to crop then.
+
+    :param merged: The merged array, or any array ending with its bottom row.
+    :param secret_shape: The (height, width) of the secret.
+    :param shape: The (height, width) of the whole merged image, when
+        merged only holds its last rows. By default, merged.shape.
+    :param bits: The number of bits per channel holding the secret.
+    :param checksum: The secret_checksum of the secret.
+    :return: Whether the header was written.
+    """
+    if not _header_fits(merged.shape if shape is None else shape, secret_shape):
+        return False
+    secret_height, secret_width = secret_shape[:2]
+    header = struct.pack(IMAGE_HEADER_FORMAT, IMAGE_HEADER_MAGIC, IMAGE_HEADER_VERSION, bits,
+                         secret_width, secret_height, checksum)
+    _embed_bits(merged[-1, -IMAGE_HEADER_PIXELS:].reshape(-1), header, 1)
+    return True
+
+
+def _read_image_header(array):
+    """Return the (bits, width, height, checksum) recorded by _write_image_header, or None.
+
+    The checksum is None for version 1 headers.
+    """
+    for version, header_format, size, pixels in (
+            (IMAGE_HEADER_VERSION, IMAGE_HEADER_FORMAT, IMAGE_HEADER_SIZE, IMAGE_HEADER_PIXELS),
+            (1, IMAGE_HEADER_V1_FORMAT, IMAGE_HEADER_V1_SIZE, IMAGE_HEADER_V1_PIXELS)):
+        if array.shape[1] < pixels:
+            continue
+        channels = np.ascontiguousarray(array[-1, -pixels:]).reshape(-1)
+        magic, header_version, bits, width, height, *checksum = struct.unpack(
+            header_format, _extract_bits(channels, size, 1)[0])
+        if (magic == IMAGE_HEADER_MAGIC and header_version == version and 1 <= bits <= 7
+                and 0 < width <= array.shape[1] and 0 < height <= array.shape[0]):
+            return bits, width, height, checksum[0] if checksum else None
+    return None
+
+
+def _check_secret(unmerged, expected):
+    """Return VERIFIED or CORRUPT for an unmerged uint8 array, UNVERIFIED without an expected checksum."""
+    if expected is None:
+        return UNVERIFIED
+    with stats.stage('verify'):
+        return VERIFIED if zlib.crc32(np.ascontiguousarray(unmerged)) == expected else CORRUPT
+
+
+def _check_file_fits(channel_count, payloadPath, bits):
+    """Raise a ValueError if embed_file can't hide payloadPath in that many channel values."""
+    needed = (FILE_HEADER_SIZE + FILE_CHECKSUM_SIZE) * 8 + -(-os.path.getsize(payloadPath) * 8 // bits)
+    if needed > channel_count:
+        raise ValueError('The payload does not fit in the cover image!')
+
+
 class Steganography:
 
     BLACK_PIXEL = (0, 0, 0)
 
+    # Rows per tile when work is split across threads
+    TILE_HEIGHT = 256
+
+    BACKENDS = ('numpy', 'numba')
+
+    def __init__(self, workers=1, backend='numpy'):
+        """
+        :param workers: The number of threads that process row tiles in
+            parallel. The output does not depend on it.
+        :param backend: 'numpy', or 'numba' for JIT-compiled single-pass
+            kernels (which use Numba's own threads instead of workers).
+            Falls back to 'numpy' when Numba is not installed; check
+            self.backend for the one in use.
+        """
+        if backend not in self.BACKENDS:
+            raise ValueError(f'backend should be one of {", ".join(self.BACKENDS)}!')
+        self.workers = workers
+        self.backend = 'numba' if backend == 'numba' and _numba_kernels() else 'numpy'
+
     def _int_to_bin(self, rgb):
         """Convert an integer tuple to a binary (string) tuple.
 
@@ -55,112 +538,1227 @@ class Steganography:
         new_rgb = r[4:] + '0000', g[4:] + '0000', b[4:] + '0000'
         return self._bin_to_int(new_rgb)
 
-    def merge(self, coverImage, secretImage):
+    def _for_each_tile(self, height, func):
+        """Call func(rows) for every tile of rows, using self.workers threads.
+
+        :param height: The number of rows to cover.
+        :param func: A function taking a slice of rows. The tiles do not
+            overlap, so the results do not depend on the order they run in.
+        """
+        tiles = [slice(top, min(top + self.TILE_HEIGHT, height))
+                 for top in range(0, height, self.TILE_HEIGHT)]
+        if self.workers <= 1 or len(tiles) <= 1:
+            for rows in tiles:
+                func(rows)
+            return
+        # NumPy releases the GIL in the bitwise ufuncs, so threads scale
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for _ in executor.map(func, tiles):
+                pass
+
+    def _merge_arrays(self, cover, secret, bits=4, out=None):
+        """Merge two uint8 RGB arrays.
+
+        The secret is placed in the top-left corner of the cover; wherever it
+        does not reach, it is treated as zero (the BLACK_PIXEL fallback).
+
+        :param cover: A uint8 array of shape (height, width, 3)
+        :param secret: A uint8 array no larger than cover
+        :param bits: The number of low bits of each cover channel that
+            receive the high bits of the secret.
+        :param out: A uint8 array shaped like cover receiving the result,
+            like a memory-mapped file. A new array by default.
+        :return: The uint8 array with the two arrays merged.
+        """
+        cover_table, secret_table = _merge_tables(bits)
+        width = secret.shape[1]
+        merged = np.empty(cover.shape, dtype=np.uint8) if out is None else out
+        if self.backend == 'numba':
+            _numba_kernels().merge_kernel(cover, secret, merged, cover_table, secret_table)
+            return merged
+
+        def merge_tile(rows):
+            np.take(cover_table, cover[rows], out=merged[rows])
+            secret_rows = secret[rows]
+            if len(secret_rows):
+                merged[rows][:len(secret_rows), :width] |= secret_table[secret_rows]
+
+        self._for_each_tile(cover.shape[0], merge_tile)
+        return merged
+
+    def _unmerge_array(self, array, bits=4, out=None):
+        """Unmerge a uint8 RGB array.
+
+        :param array: A uint8 array of shape (height, width, 3)
+        :param bits: The number of low bits holding the hidden image.
+        :param out: A uint8 array shaped like array receiving the result.
+            A new array by default.
+        :return: The uint8 array holding the hidden image.
+        """
+        table = _unmerge_table(bits)
+        unmerged = np.empty(array.shape, dtype=np.uint8) if out is None else out
+        if self.backend == 'numba':
+            _numba_kernels().unmerge_kernel(array, unmerged, table)
+            return unmerged
+
+        def unmerge_tile(rows):
+            np.take(table, array[rows], out=unmerged[rows])
+
+        self._for_each_tile(array.shape[0], unmerge_tile)
+        return unmerged
+
+    def _to_array(self, image):
+        """Convert a PIL image to a uint8 RGB array. Arrays are returned as they are."""
+        if isinstance(image, np.ndarray):
+            return image
+        with stats.stage('load'):
+            image.load()
+        with stats.stage('convert'):
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            return np.asarray(image, dtype=np.uint8)
+
+    def _secret_region(self, array, bits, info):
+        """Crop a merged array to the secret recorded in its image header or info.
+
+        :param array: The merged uint8 RGB array.
+        :param bits: The bits per channel given by the caller, or None.
+        :param info: The image info, holding the bits and checksum recorded in a PNG.
+        :return: The array, cropped to the recorded secret size if any; the
+            bits per channel: bits if given, else the recorded ones, else 4;
+            and the checksum the unmerged region should have, or None if
+            there is none or bits differs from the recorded bits.
+        """
+        header = _read_image_header(array)
+        if header is None:
+            recorded = _recorded_bits(info)
+            header = _parse_checksum(info)
+            if header is None:
+                return array, recorded if bits is None else bits, None
+            header = (recorded, *header)
+        header_bits, width, height, checksum = header
+        if bits is not None and bits != header_bits:
+            checksum = None
+        return array[:height, :width], header_bits if bits is None else bits, checksum
+
+    def merge(self, coverImage, secretImage, bits=4, fit='pad'):
         """Merge secretImage into coverImage.
 
         :param coverImage: First image
         :param secretImage: Second image
-        :return: A new merged image.
+        :param bits: The number of bits per channel (1-7) given to the
+            secret. It is recorded in the image info; use save_image to
+            keep it in the PNG.
+        :param fit: How a secret larger than the cover is handled: 'pad'
+            (an error), 'crop' or 'resize'. See prepare_secret.
+        :return: A new merged image. Its info also records the checksum of
+            the secret, which unmerge verifies.
         """
-        # Check the images dimensions
-        if secretImage.size[0] > coverImage.size[0] or secretImage.size[1] > coverImage.size[1]:
-            raise ValueError('Image 2 should be smaller than Image 1!')
+        secretImage, secret_size = prepare_secret(secretImage, coverImage.size, fit)
 
-        # Get the pixel map of the two images
-        map1 = coverImage.load()
-        map2 = secretImage.load()
-
-        new_image = Image.new(coverImage.mode, coverImage.size)
-        new_map = new_image.load()
-
-        for i in range(coverImage.size[0]):
-            for j in range(coverImage.size[1]):
-                is_valid = lambda: i < secretImage.size[0] and j < secretImage.size[1]
-                rgb1 = map1[i ,j]
-                rgb2 = map2[i, j] if is_valid() else self.BLACK_PIXEL
-                new_map[i, j] = self._merge_rgb(rgb1, rgb2)
+        cover, secret = self._to_array(coverImage), self._to_array(secretImage)
+        with stats.stage('embed'):
+            merged = self._merge_arrays(cover, secret, bits)
+            checksum = secret_checksum(secret, bits)
+            _write_image_header(merged, secret.shape, bits, checksum)
+        stats.count(pixels=coverImage.size[0] * coverImage.size[1])
+        new_image = Image.fromarray(merged, 'RGB')
+        new_image.info[BITS_KEY] = str(bits)
+        new_image.info[SECRET_SIZE_KEY] = '{}x{}'.format(*secret_size)
+        new_image.info[CHECKSUM_KEY] = _format_checksum(secret.shape, checksum)
         return new_image
 
-    def unmerge(self, image, compare=None):
+    def unmerge(self, image, compare=None, bits=None):
         """Unmerge an image.
 
         :param image: The input image.
         :param compare: The path to the original image for comparison.
-        :return: The unmerged/extracted image.
+        :param bits: The number of bits per channel holding the secret.
+            By default, the number recorded by merge, or 4.
+        :return: The unmerged/extracted image, cropped to the secret's size
+            when merge recorded it. Its info[STATUS_KEY] is VERIFIED or
+            CORRUPT when merge recorded a checksum, else UNVERIFIED.
         """
-        pixel_map = image.load()
+        array = self._to_array(image)
+        array, bits, checksum = self._secret_region(array, bits, image.info)
+        with stats.stage('extract'):
+            unmerged = self._unmerge_array(array, bits)
+        decoded = Image.fromarray(unmerged, 'RGB')
+        decoded.info[STATUS_KEY] = _check_secret(unmerged, checksum)
+        stats.count(pixels=array.shape[0] * array.shape[1])
 
-        # Create the new image and load the pixel map
-        new_image = Image.new(image.mode, image.size)
-        new_map = new_image.load()
-
-        original_image = None
         if compare:
-            original_image = Image.open(compare)
+            print()
+            print_metrics(self.compare(decoded, open_image(compare)))
+            print()
 
-        ssim_value, psnr_value, mse_value = 0, 0, 0
+        return decoded
 
-        for i in range(image.size[0]):
-            for j in range(image.size[1]):
-                decoded_pixel = self._unmerge_rgb(pixel_map[i, j])
-                new_map[i, j] = decoded_pixel
+    def merge_stream(self, coverPath, secretPath, outputPath, strip_height=256, bits=4, compress_level=None):
+        """Merge secretPath into coverPath strip by strip and write a PNG.
 
-                if compare and original_image and i < original_image.size[0] and j < original_image.size[1]:
-                    original_pixel = original_image.getpixel((i, j))
+        Only one strip of rows of each image is held in memory at a time,
+        so peak memory depends on strip_height and not on the image size.
 
-                    # Convert pixels to numpy arrays for metric calculations
-                    decoded_np = np.array(decoded_pixel)
-                    original_np = np.array(original_pixel)
+        :param coverPath: First image path
+        :param secretPath: Second image path
+        :param outputPath: The output PNG path
+        :param strip_height: The number of rows processed at a time.
+        :param bits: The number of bits per channel (1-7) given to the secret.
+        :param compress_level: The PNG zlib level, 0-9 (default: 6).
+            The checksum of the secret is only known once every strip is
+            merged, so it is written in a text chunk after the pixels; the
+            size of the secret goes in a text chunk before them, so
+            unmerge_stream can crop its output.
+        """
+        _merge_tables(bits)  # Fail on a bad value before writing anything
+        with StripReader(coverPath, strip_height) as cover, StripReader(secretPath, strip_height) as secret:
+            if secret.size[0] > cover.size[0] or secret.size[1] > cover.size[1]:
+                raise ValueError('Image 2 should be smaller than Image 1!')
 
-                    # Calculate metrics
-                    ssim_value += ssim(original_np, decoded_np, win_size=3, full=True)[1].mean()
-                    if decoded_pixel != original_pixel:
-                        psnr_value += psnr(original_np, decoded_np)
-                    mse_value += mse(original_np, decoded_np)
+            secret_strips = stats.iterate('load', secret)
+            empty = np.zeros((0, secret.size[0], 3), dtype=np.uint8)
+            size = '{}x{}'.format(*secret.size)
+            text = {BITS_KEY: str(bits), SECRET_SIZE_KEY: size, MERGED_SIZE_KEY: size}
+            checksum = 0
+            with PngStripWriter(outputPath, cover.size, text=text,
+                                compress_level=6 if compress_level is None else compress_level) as writer:
+                for cover_strip in stats.iterate('load', cover):
+                    secret_strip = next(secret_strips, empty)
+                    with stats.stage('embed'):
+                        merged = self._merge_arrays(cover_strip, secret_strip, bits)
+                        checksum = secret_checksum(secret_strip, bits, checksum)
+                        if writer.rows_written + len(merged) == cover.size[1]:
+                            _write_image_header(merged, secret.size[::-1], bits, checksum, cover.size[::-1])
+                    with stats.stage('save'):
+                        writer.write(merged)
+                writer.add_text(CHECKSUM_KEY, _format_checksum(secret.size[::-1], checksum))
+            stats.count(pixels=cover.size[0] * cover.size[1])
+        stats.count(bytes_written=os.path.getsize(outputPath))
 
-        if compare and original_image:
-            num_pixels = image.size[0] * image.size[1]
-            ssim_value /= num_pixels
-            psnr_value /= num_pixels
-            mse_value /= num_pixels
+    def unmerge_stream(self, imagePath, outputPath, strip_height=256, bits=None, compress_level=None):
+        """Unmerge imagePath strip by strip and write a PNG.
 
-            print()
-            print(f'Structural Similarity Index (SSIM): {ssim_value:.4f}')
-            print(f'Peak Signal-to-Noise Ratio (PSNR): {psnr_value:.2f} dB')
-            print(f'Mean Squared Error (MSE): {mse_value:.2f}')
-            print()
+        The output is cropped to the secret when its size is known before
+        the pixels are read: from the header of a raw input, from the
+        checksum text chunk save_image writes, or from the size text chunk
+        merge_stream writes before its pixels.
 
-            # print(f'Mean Absolute Error (MAE): {mae_value:.2f}')
+        :param imagePath: The input image path.
+        :param outputPath: The output PNG path
+        :param strip_height: The number of rows processed at a time.
+        :param bits: The number of bits per channel holding the secret.
+            By default, the number recorded by merge, or 4.
+        :param compress_level: The PNG zlib level, 0-9 (default: 6).
+        :return: VERIFIED or CORRUPT when merge recorded a checksum for the
+            output's size, else UNVERIFIED.
+        """
+        with StripReader(imagePath, strip_height) as image:
+            size, checksum = image.size, None
+            recorded_bits = _recorded_bits(image.info)
+            # The image header is in the last row: only mapped raw inputs can read it up front
+            if is_raw(imagePath):
+                region, bits, checksum = self._secret_region(open_pixels(imagePath), bits, image.info)
+                size = region.shape[1], region.shape[0]
+            else:
+                recorded = _parse_checksum(image.info)
+                if recorded is not None:
+                    size = recorded[:2]
+                    if bits in (None, recorded_bits):
+                        checksum = recorded[2]
+                else:
+                    size = _parse_merged_size(image.info) or size
+                bits = recorded_bits if bits is None else bits
+            unmerged_checksum = 0
+            with PngStripWriter(outputPath, size,
+                                compress_level=6 if compress_level is None else compress_level) as writer:
+                for strip in stats.iterate('load', image):
+                    strip = strip[:size[1] - writer.rows_written, :size[0]]
+                    with stats.stage('extract'):
+                        unmerged = self._unmerge_array(strip, bits)
+                    with stats.stage('verify'):
+                        unmerged_checksum = zlib.crc32(unmerged, unmerged_checksum)
+                    with stats.stage('save'):
+                        writer.write(unmerged)
+                    if writer.rows_written == size[1]:
+                        break
+            stats.count(pixels=size[0] * size[1])
+            # The checksum merge_stream writes follows the rows a cropped output stops before
+            image.read_trailing_text()
+            if checksum is None:
+                # merge_stream writes the checksum after the pixels
+                recorded = _parse_checksum(image.info)
+                if recorded is not None and recorded[:2] == size and bits == recorded_bits:
+                    checksum = recorded[2]
+        stats.count(bytes_written=os.path.getsize(outputPath))
+        if checksum is None:
+            return UNVERIFIED
+        return VERIFIED if unmerged_checksum == checksum else CORRUPT
 
-        return new_image
+    def _load_pixels(self, path):
+        """Map a raw (.npy or PPM) image file, or decode any other image file."""
+        if is_raw(path):
+            with stats.stage('load'):
+                return open_pixels(path)
+        return self._to_array(Image.open(path))
+
+    def merge_mapped(self, coverPath, secretPath, outputPath, bits=4):
+        """Merge secretPath into coverPath, writing straight into a mapped output file.
+
+        Raw .npy and PPM inputs are memory-mapped instead of being read,
+        and the output (.npy or PPM) is mapped and filled in place, so no
+        PIL image and no full copy of the pixels is made.
+
+        :param coverPath: First image path
+        :param secretPath: Second image path
+        :param outputPath: The output path, ending with .npy or .ppm
+        :param bits: The number of bits per channel (1-7) given to the secret.
+        """
+        cover, secret = self._load_pixels(coverPath), self._load_pixels(secretPath)
+        if secret.shape[0] > cover.shape[0] or secret.shape[1] > cover.shape[1]:
+            raise ValueError('Image 2 should be smaller than Image 1!')
+        _merge_tables(bits)  # Fail on a bad value before writing anything
+        _check_recordable(outputPath, bits, cover.shape, secret.shape)
+
+        # The checksum goes in the PPM header, so it is computed before the output is created
+        with stats.stage('embed'):
+            checksum = secret_checksum(secret, bits)
+        text = {BITS_KEY: str(bits), SECRET_SIZE_KEY: '{}x{}'.format(secret.shape[1], secret.shape[0]),
+                CHECKSUM_KEY: _format_checksum(secret.shape, checksum)}
+        output = create_pixels(outputPath, cover.shape, text)
+        with stats.stage('embed'):
+            self._merge_arrays(cover, secret, bits, out=output)
+            _write_image_header(output, secret.shape, bits, checksum)
+        with stats.stage('save'):
+            output.flush()
+        stats.count(pixels=cover.shape[0] * cover.shape[1])
+        stats.count(bytes_written=os.path.getsize(outputPath))
+
+    def unmerge_mapped(self, imagePath, outputPath, bits=None):
+        """Unmerge imagePath, writing straight into a mapped output file.
+
+        :param imagePath: The input image path.
+        :param outputPath: The output path, ending with .npy or .ppm
+        :param bits: The number of bits per channel holding the secret.
+            By default, the number recorded by merge, or 4.
+        :return: The output pixels, mapped read-only, cropped to the
+            secret's size when merge recorded it, and VERIFIED, CORRUPT or
+            UNVERIFIED as for unmerge.
+        """
+        info = read_text(imagePath) if is_raw(imagePath) else open_image(imagePath).info
+        image, bits, checksum = self._secret_region(self._load_pixels(imagePath), bits, info)
+
+        output = create_pixels(outputPath, image.shape)
+        with stats.stage('extract'):
+            self._unmerge_array(image, bits, out=output)
+        with stats.stage('save'):
+            output.flush()
+        status = _check_secret(output, checksum)
+        stats.count(pixels=image.shape[0] * image.shape[1])
+        stats.count(bytes_written=os.path.getsize(outputPath))
+        return open_pixels(outputPath), status
+
+    def embed_file(self, coverImage, payloadPath, bits=1):
+        """Hide an arbitrary file in coverImage.
+
+        The file is read in chunks and its bits are written straight into
+        the low bits of the cover's channel values, after a small header
+        holding its size and CRC32.
+
+        :param coverImage: The cover image.
+        :param payloadPath: The path of the file to hide.
+        :param bits: The number of low bits of each channel value (1-7)
+            receiving the payload.
+        :return: A new image holding the file. Save it in a lossless format.
+        """
+        _check_bits(bits)
+        pixels = np.array(self._to_array(coverImage))
+        self._embed_file_into(pixels.reshape(-1), payloadPath, bits)
+        stats.count(pixels=coverImage.size[0] * coverImage.size[1])
+        return Image.fromarray(pixels, 'RGB')
+
+    def embed_file_mapped(self, coverPath, payloadPath, outputPath, bits=1):
+        """Hide an arbitrary file, writing straight into a mapped output file.
+
+        Like merge_mapped: a raw (.npy or PPM) cover is memory-mapped, and
+        the output (.npy or PPM) is created at its final size, mapped, and
+        receives the cover and then the payload in place, so the pixels are
+        never copied in memory.
+
+        :param coverPath: The cover image path.
+        :param payloadPath: The path of the file to hide.
+        :param outputPath: The output path, ending with .npy or .ppm
+        :param bits: The number of low bits of each channel value (1-7)
+            receiving the payload.
+        """
+        _check_bits(bits)
+        cover = self._load_pixels(coverPath)
+        _check_file_fits(cover.size, payloadPath, bits)  # Before creating the output
+        output = create_pixels(outputPath, cover.shape)
+        with stats.stage('embed'):
+            output[...] = cover
+        self._embed_file_into(output.reshape(-1), payloadPath, bits)
+        with stats.stage('save'):
+            output.flush()
+        stats.count(pixels=cover.shape[0] * cover.shape[1])
+        stats.count(bytes_written=os.path.getsize(outputPath))
+
+    def _embed_file_into(self, channels, payloadPath, bits):
+        """Write the header and payload of embed_file into flat channel values, in place."""
+        _check_file_fits(len(channels), payloadPath, bits)
+        size = os.path.getsize(payloadPath)
+        position = (FILE_HEADER_SIZE + FILE_CHECKSUM_SIZE) * 8
+
+        checksum = 0
+        with open(payloadPath, 'rb') as payload:
+            # A multiple of bits bytes, so that only the last chunk is padded
+            for chunk in stats.iterate('read', iter(lambda: payload.read(bits * FILE_CHUNK_SIZE), b'')):
+                with stats.stage('embed'):
+                    position += _embed_bits(channels[position:], chunk, bits)
+                    checksum = zlib.crc32(chunk, checksum)
+        # The header goes in last, once the checksum is known
+        header = struct.pack(FILE_HEADER_FORMAT, FILE_HEADER_MAGIC, FILE_HEADER_VERSION, bits, size)
+        _embed_bits(channels, header + struct.pack(FILE_CHECKSUM_FORMAT, checksum), 1)
+
+    def _read_file_header(self, channels):
+        """Read the header written by embed_file.
+
+        :param channels: The flat uint8 channel values of the image.
+        :return: The bits per channel, the payload size, its CRC32 (None for
+            version 1 headers) and the index of the first payload value.
+        """
+        header, position = _extract_bits(channels, FILE_HEADER_SIZE, 1)
+        magic, version, bits, size = struct.unpack(FILE_HEADER_FORMAT, header)
+        if magic != FILE_HEADER_MAGIC or version not in (1, FILE_HEADER_VERSION) or not 1 <= bits <= 7:
+            raise ValueError('The image does not hold an embedded file!')
+        checksum = None
+        if version >= 2:
+            data, count = _extract_bits(channels[position:], FILE_CHECKSUM_SIZE, 1)
+            checksum, = struct.unpack(FILE_CHECKSUM_FORMAT, data)
+            position += count
+        return bits, size, checksum, position
+
+    def _iter_file(self, channels, bits, size, position):
+        """Yield the payload of an embedded file in chunks."""
+        for start in range(0, size, bits * FILE_CHUNK_SIZE):
+            with stats.stage('extract'):
+                chunk, count = _extract_bits(channels[position:], min(bits * FILE_CHUNK_SIZE, size - start), bits)
+            yield chunk
+            position += count
+
+    def extract_file(self, image, outputPath):
+        """Extract a file hidden by embed_file.
+
+        :param image: The image holding the file.
+        :param outputPath: The path the file is written to, in chunks.
+        :return: The size of the extracted file.
+        :raise ValueError: If the file does not match the checksum recorded
+            by embed_file. It is still written to outputPath.
+        """
+        size = self._extract_file_from(self._to_array(image).reshape(-1), outputPath)
+        stats.count(pixels=image.size[0] * image.size[1])
+        return size
+
+    def extract_file_mapped(self, imagePath, outputPath):
+        """Extract a file hidden by embed_file from a raw (.npy or PPM) image, without reading it whole.
+
+        The image is memory-mapped, so only the pages holding the header and
+        the payload are read.
+
+        :param imagePath: The image path, ending with .npy or .ppm
+        :param outputPath: The path the file is written to, in chunks.
+        :return: The size of the extracted file.
+        :raise ValueError: As extract_file.
+        """
+        pixels = open_pixels(imagePath)
+        size = self._extract_file_from(pixels.reshape(-1), outputPath)
+        stats.count(pixels=pixels.shape[0] * pixels.shape[1])
+        return size
+
+    def _extract_file_from(self, channels, outputPath):
+        """Write the file embedded in flat channel values to outputPath, checking its checksum."""
+        bits, size, expected, position = self._read_file_header(channels)
+
+        checksum = 0
+        with open(outputPath, 'wb') as output:
+            for chunk in self._iter_file(channels, bits, size, position):
+                with stats.stage('save'):
+                    output.write(chunk)
+                checksum = zlib.crc32(chunk, checksum)
+        stats.count(bytes_written=size)
+        if expected is not None and checksum != expected:
+            raise ValueError(f'The extracted file does not match its checksum, {outputPath} is damaged!')
+        return size
+
+    def verify(self, image):
+        """Check the data merge or embed_file hid in an image against its checksum.
+
+        Nothing is written: the secret or file is extracted and hashed in a
+        single pass.
+
+        :param image: The image to check.
+        :return: The kind of data found, 'image', 'file' or None, and
+            VERIFIED, CORRUPT or UNVERIFIED (also for images holding neither).
+        """
+        array = self._to_array(image)
+        header = _read_image_header(array)
+        if header is not None or _parse_checksum(image.info) is not None:
+            region, bits, checksum = self._secret_region(array, None, image.info)
+            with stats.stage('extract'):
+                unmerged = self._unmerge_array(region, bits)
+            return 'image', _check_secret(unmerged, checksum)
+
+        channels = np.ascontiguousarray(array).reshape(-1)
+        try:
+            bits, size, expected, position = self._read_file_header(channels)
+        except ValueError:
+            return None, UNVERIFIED
+        if expected is None:
+            return 'file', UNVERIFIED
+        checksum = 0
+        try:
+            for chunk in self._iter_file(channels, bits, size, position):
+                with stats.stage('verify'):
+                    checksum = zlib.crc32(chunk, checksum)
+        except ValueError:
+            # The recorded size runs past the image
+            return 'file', CORRUPT
+        return 'file', VERIFIED if checksum == expected else CORRUPT
+
+    def compare(self, image, original, per_channel=False):
+        """Compute quality metrics between two images.
+
+        The metrics are computed once over the whole overlapping region
+        (the top-left corner both images share).
+
+        :param image: The image to evaluate, usually the unmerged one.
+        :param original: The reference image.
+        :param per_channel: Also compute the metrics for each RGB channel.
+        :return: A dict with 'ssim', 'psnr' and 'mse' keys, plus a
+            'channels' dict keyed by 'R', 'G' and 'B' if per_channel is set.
+        """
+        image, original = self._to_array(image), self._to_array(original)
+        height = min(image.shape[0], original.shape[0])
+        width = min(image.shape[1], original.shape[1])
+        image, original = image[:height, :width], original[:height, :width]
+
+        with stats.stage('metrics'):
+            metrics = _metrics(original, image)
+            if per_channel:
+                metrics['channels'] = {
+                    name: _metrics(original[..., c], image[..., c])
+                    for c, name in enumerate('RGB')
+                }
+        return metrics
+
+
+def _metrics(original, image):
+    """Compute SSIM, PSNR and MSE between two uint8 arrays of equal shape."""
+    from skimage.metrics import mean_squared_error as mse
+    from skimage.metrics import peak_signal_noise_ratio as psnr
+    from skimage.metrics import structural_similarity as ssim
+
+    # SSIM needs an odd window no larger than the image
+    win_size = min(7, image.shape[0], image.shape[1])
+    if win_size % 2 == 0:
+        win_size -= 1
+    if win_size < 3:
+        raise ValueError('Images should be at least 3x3 to be compared!')
+
+    channel_axis = 2 if image.ndim == 3 else None
+    return {
+        'ssim': float(ssim(original, image, win_size=win_size, data_range=255, channel_axis=channel_axis)),
+        'psnr': float(psnr(original, image, data_range=255)),
+        'mse': float(mse(original, image)),
+    }
+
+
+def print_metrics(metrics):
+    """Print metrics as returned by Steganography.compare."""
+    print(f'Structural Similarity Index (SSIM): {metrics["ssim"]:.4f}')
+    print(f'Peak Signal-to-Noise Ratio (PSNR): {metrics["psnr"]:.2f} dB')
+    print(f'Mean Squared Error (MSE): {metrics["mse"]:.2f}')
+    for name, channel in metrics.get('channels', {}).items():
+        print(f'  {name}: SSIM {channel["ssim"]:.4f}, PSNR {channel["psnr"]:.2f} dB, MSE {channel["mse"]:.2f}')
+
+
+def metrics_to_json(metrics):
+    """Serialize metrics to JSON; an infinite PSNR (identical images) becomes null."""
+    def clean(value):
+        if isinstance(value, dict):
+            return {k: clean(v) for k, v in value.items()}
+        return value if np.isfinite(value) else None
+    return json.dumps(clean(metrics))
+
+
+# The inputs and output of each batch job command, as manifest field names
+BATCH_FIELDS = {
+    'merge': (('coverImage', 'secretImage'), 'output'),
+    'unmerge': (('image',), 'output'),
+    'compare': (('image', 'original'), 'output'),
+}
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff', '.npy')
+
+
+def load_manifest(path):
+    """Load batch jobs from a CSV (with a header row) or JSONL manifest.
+
+    Every job has a 'command' field (merge, unmerge or compare) and the
+    same fields as the matching subcommand: coverImage/secretImage/output,
+    image/output or image/original. Merge and unmerge jobs may set bits,
+    and merge jobs fit.
+    An optional output on a compare job receives the metrics as JSON.
+
+    :param path: The manifest path.
+    :return: A list of job dicts.
+    """
+    with open(path, newline='') as file:
+        if path.endswith('.jsonl'):
+            jobs = [json.loads(line) for line in file if line.strip()]
+        else:
+            jobs = list(csv.DictReader(file))
+    for number, job in enumerate(jobs, 1):
+        if job.get('command') not in BATCH_FIELDS:
+            raise ValueError(f'{path}: job {number} has an unknown command {job.get("command")!r}')
+        inputs, _ = BATCH_FIELDS[job['command']]
+        missing = [field for field in inputs if not job.get(field)]
+        if missing:
+            raise ValueError(f'{path}: job {number} is missing {", ".join(missing)}')
+    return jobs
+
+
+def directory_jobs(cover_dir, secret_dir, output_dir):
+    """Build merge jobs for the covers and secrets sharing a file name stem.
+
+    :param cover_dir: The directory of cover images.
+    :param secret_dir: The directory of secret images.
+    :param output_dir: The directory receiving <stem>.png for every pair.
+    :return: A list of job dicts.
+    """
+    def images(directory):
+        return {os.path.splitext(name)[0]: os.path.join(directory, name)
+                for name in sorted(os.listdir(directory))
+                if name.lower().endswith(IMAGE_EXTENSIONS)}
+
+    covers, secrets = images(cover_dir), images(secret_dir)
+    return [{'command': 'merge', 'coverImage': covers[stem], 'secretImage': secrets[stem],
+             'output': os.path.join(output_dir, stem + '.png')}
+            for stem in sorted(covers.keys() & secrets.keys())]
+
+
+def _job_paths(job):
+    """Return the input paths and the output path (or None) of a job."""
+    inputs, output = BATCH_FIELDS[job['command']]
+    return [job[field] for field in inputs], job.get(output) or None
+
+
+def is_up_to_date(job):
+    """Whether the output of a job exists and is newer than all its inputs.
+
+    A job with a missing input is not up to date, so it runs and reports
+    its own failure instead of aborting the batch here.
+    """
+    inputs, output = _job_paths(job)
+    if not output or not os.path.exists(output):
+        return False
+    output_mtime = os.path.getmtime(output)
+    try:
+        return all(os.path.getmtime(path) <= output_mtime for path in inputs)
+    except FileNotFoundError:
+        return False
+
+
+def run_job(job):
+    """Run one batch job.
+
+    :param job: A job dict as returned by load_manifest.
+    :return: The number of input bytes read and, for compare jobs, the metrics.
+    """
+    size, images = _read_job(job)
+    return size, _write_job(job, _compute_job(job, images))
+
+
+def _read_job(job):
+    """Decode the input images of a job.
+
+    :return: The number of input bytes and the loaded images.
+    """
+    inputs, output = _job_paths(job)
+    if job['command'] == 'merge':
+        check_lossless(output)
+    images = [open_image(path) for path in inputs]
+    # merge decodes a secret it resizes itself, at a reduced scale when it can
+    loaded = images[:1] if job['command'] == 'merge' and job.get('fit') == 'resize' else images
+    with stats.stage('load'):
+        for image in loaded:
+            image.load()
+    return sum(os.path.getsize(path) for path in inputs), images
+
+
+def _compute_job(job, images):
+    """Run the kernels of a job on its decoded images: the output image, or the metrics."""
+    bits = int(job['bits']) if job.get('bits') else None
+    if job['command'] == 'merge':
+        return Steganography().merge(images[0], images[1], bits=bits or 4, fit=job.get('fit') or 'pad')
+    elif job['command'] == 'unmerge':
+        return Steganography().unmerge(images[0], bits=bits)
+    return Steganography().compare(images[0], images[1])
+
+
+def _write_job(job, result):
+    """Save the result of a job to its output, returning the metrics of compare jobs."""
+    output = _job_paths(job)[1]
+    if job['command'] != 'compare':
+        save_image(result, output)
+        return None
+    if output:
+        with open(output, 'w') as file:
+            file.write(metrics_to_json(result))
+    return result
+
+
+def _run_job_safely(job):
+    """Run a job in a worker process, returning the error instead of raising it."""
+    try:
+        return run_job(job) + (None,)
+    except Exception as error:
+        return 0, None, f'{type(error).__name__}: {error}'
+
+
+def _job_waves(jobs):
+    """Group jobs so that a job reading another job's output runs after it.
+
+    :param jobs: A list of job dicts.
+    :return: A list of lists of jobs; the jobs within a list are independent.
+    """
+    producers = {}
+    for index, job in enumerate(jobs):
+        output = _job_paths(job)[1]
+        if output:
+            producers[os.path.abspath(output)] = index
+
+    levels = []
+    for job in jobs:
+        level = 0
+        for path in _job_paths(job)[0]:
+            producer = producers.get(os.path.abspath(path))
+            # Only earlier jobs count, which also rules out cycles
+            if producer is not None and producer < len(levels):
+                level = max(level, levels[producer] + 1)
+        levels.append(level)
+    return [[job for job, level in zip(jobs, levels) if level == wave]
+            for wave in range(max(levels, default=-1) + 1)]
+
+
+def run_batch(jobs, processes=None, force=False):
+    """Run batch jobs across a process pool and print a summary.
+
+    A failing job is reported and does not stop the others. Jobs that read
+    the output of an earlier job in the list wait for it to finish.
+
+    :param jobs: A list of job dicts.
+    :param processes: The number of worker processes, all cores by default.
+    :param force: Also run jobs whose output is up to date.
+    :return: The number of failed jobs.
+    """
+    failed, done, skipped, total_bytes = 0, 0, 0, 0
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for wave in _job_waves(jobs):
+            pending = [job for job in wave if force or not is_up_to_date(job)]
+            skipped += len(wave) - len(pending)
+            for job, (size, metrics, error) in zip(pending, executor.map(_run_job_safely, pending)):
+                if _report_job(job, metrics, error):
+                    done += 1
+                    total_bytes += size
+                else:
+                    failed += 1
+    elapsed = time.perf_counter() - start
+
+    _print_batch_summary(done, skipped, failed, total_bytes, elapsed)
+    return failed
+
+
+def _report_job(job, metrics, error):
+    """Print the failure or the metrics of a finished job; return whether it succeeded."""
+    inputs, output = _job_paths(job)
+    if error:
+        print(f'FAILED {job["command"]} {" ".join(inputs)}: {error}')
+        return False
+    if metrics is not None and not output:
+        print(f'{job["command"]} {" ".join(inputs)}: {metrics_to_json(metrics)}')
+    return True
+
+
+def _print_batch_summary(done, skipped, failed, total_bytes, elapsed):
+    rate = done / elapsed if elapsed else 0
+    throughput = total_bytes / 1e6 / elapsed if elapsed else 0
+    print(f'{done} done, {skipped} skipped, {failed} failed in {elapsed:.2f}s '
+          f'({rate:.2f} images/s, {throughput:.2f} MB/s)')
+
+
+class Pipeline:
+    """Run batch jobs through read, compute and write stages overlapping each other.
+
+    Each stage is a pool of threads taking work from a bounded queue: the
+    readers decode the inputs, the compute threads run the kernels and the
+    writers encode and save the outputs. Decoding, the NumPy kernels and
+    zlib all release the GIL, so while one image is being written the next
+    is computed and the one after is read. At most in_flight jobs are
+    between reading and writing at a time, which bounds the memory used
+    by decoded images.
+    """
+
+    STAGES = ('read', 'compute', 'write')
+
+    def __init__(self, readers=2, computers=1, writers=2, in_flight=8):
+        """
+        :param readers: The number of threads decoding inputs.
+        :param computers: The number of threads running the kernels.
+        :param writers: The number of threads encoding and saving outputs.
+        :param in_flight: The most jobs admitted and not yet written.
+        """
+        self.threads = {'read': readers, 'compute': computers, 'write': writers}
+        self.in_flight = in_flight
+        # Seconds each stage spent working, summed over its threads
+        self.busy = dict.fromkeys(self.STAGES, 0.0)
+        self._lock = threading.Lock()
+
+    def run(self, jobs):
+        """Run jobs, yielding (job, input bytes, metrics, error) as they finish.
+
+        A job failing in any stage skips the stages after it.
+        """
+        slots = threading.Semaphore(self.in_flight)
+        # Set when the caller stops iterating: the feeder stops and the stages drop their work
+        stopping = threading.Event()
+        queues = [Queue(self.in_flight) for _ in range(len(self.STAGES) + 1)]
+        functions = {'read': lambda job, _: _read_job(job),
+                     'compute': lambda job, value: (value[0], _compute_job(job, value[1])),
+                     'write': lambda job, value: (value[0], _write_job(job, value[1]))}
+        threads = []
+        for index, stage in enumerate(self.STAGES):
+            for _ in range(self.threads[stage]):
+                thread = threading.Thread(target=self._work, daemon=True,
+                                          args=(stage, functions[stage], queues[index], queues[index + 1], stopping))
+                thread.start()
+                threads.append((queues[index], thread))
+
+        def feed():
+            for job in jobs:
+                # Backpressure: wait until a job leaves the pipeline
+                slots.acquire()
+                if stopping.is_set():
+                    return
+                queues[0].put((job, None, None))
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            for _ in range(len(jobs)):
+                job, value, error = queues[-1].get()
+                slots.release()
+                size, metrics = value if value else (0, None)
+                yield job, size, metrics, error
+        finally:
+            stopping.set()
+            # Wake the feeder if it waits for a slot
+            slots.release()
+            feeder.join()
+            for inbox, _ in threads:
+                inbox.put(None)
+            for _, thread in threads:
+                thread.join()
+
+    def _work(self, stage, function, inbox, outbox, stopping):
+        while True:
+            item = inbox.get()
+            if item is None:
+                return
+            if stopping.is_set():
+                continue
+            job, value, error = item
+            if not error:
+                start = time.perf_counter()
+                try:
+                    value = function(job, value)
+                except Exception as exception:
+                    value, error = None, f'{type(exception).__name__}: {exception}'
+                with self._lock:
+                    self.busy[stage] += time.perf_counter() - start
+            outbox.put((job, value, error))
+
+    def utilization(self, elapsed):
+        """Return the fraction of the elapsed time each stage's threads were busy."""
+        return {stage: self.busy[stage] / (elapsed * self.threads[stage]) if elapsed else 0
+                for stage in self.STAGES}
+
+
+def run_pipeline(jobs, readers=2, computers=1, writers=2, in_flight=8, force=False):
+    """Run batch jobs through a Pipeline in this process and print a summary.
+
+    Like run_batch, failures are reported without stopping the run and
+    jobs reading an earlier job's output wait for it. The summary adds how
+    busy each stage was: the stage close to 100% is the bottleneck, and
+    giving it more threads is what speeds the batch up.
+
+    :param jobs: A list of job dicts.
+    :param readers: The number of threads decoding inputs.
+    :param computers: The number of threads running the kernels.
+    :param writers: The number of threads encoding and saving outputs.
+    :param in_flight: The most jobs between reading and writing at a time.
+    :param force: Also run jobs whose output is up to date.
+    :return: The number of failed jobs.
+    """
+    failed, done, skipped, total_bytes = 0, 0, 0, 0
+    pipeline = Pipeline(readers, computers, writers, in_flight)
+
+    start = time.perf_counter()
+    for wave in _job_waves(jobs):
+        pending = [job for job in wave if force or not is_up_to_date(job)]
+        skipped += len(wave) - len(pending)
+        for job, size, metrics, error in pipeline.run(pending):
+            if _report_job(job, metrics, error):
+                done += 1
+                total_bytes += size
+            else:
+                failed += 1
+    elapsed = time.perf_counter() - start
+
+    _print_batch_summary(done, skipped, failed, total_bytes, elapsed)
+    print('Stage busy time: ' + ', '.join(
+        f'{stage} {fraction:.0%} of {pipeline.threads[stage]} thread(s)'
+        for stage, fraction in pipeline.utilization(elapsed).items()))
+    return failed
+
+
+def _add_output_options(parser):
+    parser.add_argument('--compress-level', type=int, choices=range(10), default=None, metavar='0-9',
+                        help='PNG compression level, 0 is fastest and 9 smallest (default: 6)')
+    parser.add_argument('--optimize', action='store_true', help='Search for the smallest PNG encoding (slow)')
 
 
 def main():
     parser = argparse.ArgumentParser(description='Steganography')
+    parser.add_argument('--stats-json', help='Write the wall time per stage, pixels/s and bytes written to this path')
+    parser.add_argument('--profile', help='Run under cProfile and write the pstats file to this path')
+    parser.add_argument('--cache', action='store_true',
+                        help='Reuse the output of an earlier merge, unmerge or embed-file run with the same inputs')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIRECTORY, help='Directory of the --cache results')
     subparser = parser.add_subparsers(dest='command')
 
     merge = subparser.add_parser('merge')
     merge.add_argument('--coverImage', required=True, help='coverImage path')
     merge.add_argument('--secretImage', required=True, help='secretImage path')
-    merge.add_argument('--output', required=True, help='Output path')
+    merge.add_argument('--output', required=True, help='Output path (PNG, BMP, PPM, TIFF or .npy)')
+    merge.add_argument('--stream', action='store_true', help='Process row strips to bound memory (PNG output)')
+    _add_output_options(merge)
+    merge.add_argument('--strip-height', type=int, default=256, help='Rows per strip with --stream')
+    merge.add_argument('--workers', type=int, default=1, help='Number of threads processing row tiles')
+    merge.add_argument('--backend', choices=Steganography.BACKENDS, default='numpy',
+                         help='Pixel kernels: numpy, or numba JIT (falls back to numpy without Numba)')
+    merge.add_argument('--bits', type=int, choices=range(1, 8), default=4, metavar='1-7', help='Bits per channel given to the secret, 1-7')
+    merge.add_argument('--fit', choices=FIT_MODES, default='pad',
+                       help='A secret larger than the cover is an error (pad), cropped, or resized to fit')
 
     unmerge = subparser.add_parser('unmerge')
     unmerge.add_argument('--image', required=True, help='Image path')
     unmerge.add_argument('--output', required=True, help='Output path')
     unmerge.add_argument('--compare', required=False, help='Compare original secret path')
+    unmerge.add_argument('--stream', action='store_true', help='Process row strips to bound memory (PNG output)')
+    _add_output_options(unmerge)
+    unmerge.add_argument('--strip-height', type=int, default=256, help='Rows per strip with --stream')
+    unmerge.add_argument('--workers', type=int, default=1, help='Number of threads processing row tiles')
+    unmerge.add_argument('--backend', choices=Steganography.BACKENDS, default='numpy',
+                         help='Pixel kernels: numpy, or numba JIT (falls back to numpy without Numba)')
+    unmerge.add_argument('--bits', type=int, choices=range(1, 8), default=None, metavar='1-7', help='Bits per channel holding the secret (default: as recorded by merge)')
+
+    compare = subparser.add_parser('compare')
+    compare.add_argument('--image', required=True, help='Image path')
+    compare.add_argument('--original', required=True, help='Original image path')
+    compare.add_argument('--per-channel', action='store_true', help='Also report metrics per RGB channel')
+    compare.add_argument('--json', action='store_true', help='Print the metrics as JSON')
+
+    embed_file = subparser.add_parser('embed-file')
+    embed_file.add_argument('--coverImage', required=True, help='coverImage path')
+    embed_file.add_argument('--payload', required=True, help='Path of the file to hide')
+    embed_file.add_argument('--output', required=True, help='Output path (PNG, BMP, PPM, TIFF or .npy)')
+    embed_file.add_argument('--bits', type=int, choices=range(1, 8), default=1, metavar='1-7', help='Bits per channel receiving the payload, 1-7')
+    _add_output_options(embed_file)
+
+    extract_file = subparser.add_parser('extract-file')
+    extract_file.add_argument('--image', required=True, help='Image path')
+    extract_file.add_argument('--output', required=True, help='Path of the extracted file')
+
+    verify = subparser.add_parser('verify', help='Check hidden images, files or text against their checksums')
+    verify.add_argument('--image', required=True, nargs='+', help='Image paths')
+    verify.add_argument('--key', help='Key of the hidden text, to also check it decrypts')
+    verify.add_argument('--strict', action='store_true', help='Also fail for images with no checksum to check')
+
+    batch = subparser.add_parser('batch')
+    batch.add_argument('--manifest', help='CSV or JSONL manifest of jobs')
+    batch.add_argument('--covers', help='Directory of cover images, paired with --secrets by file name')
+    batch.add_argument('--secrets', help='Directory of secret images')
+    batch.add_argument('--output-dir', help='Directory receiving the merged images of --covers/--secrets')
+    batch.add_argument('--processes', type=int, default=None, help='Number of worker processes (default: all cores)')
+    batch.add_argument('--force', action='store_true', help='Also run jobs whose output is up to date')
+    batch.add_argument('--pipeline', action='store_true',
+                       help='Overlap decoding, kernels and saving in thread stages of one process')
+    batch.add_argument('--readers', type=int, default=2, help='Decoding threads with --pipeline')
+    batch.add_argument('--compute-threads', type=int, default=1, help='Kernel threads with --pipeline')
+    batch.add_argument('--writers', type=int, default=2, help='Encoding and saving threads with --pipeline')
+    batch.add_argument('--in-flight', type=int, default=8,
+                       help='Most images between reading and writing with --pipeline, bounds memory')
+
+    cache = subparser.add_parser('cache')
+    cache.add_argument('action', choices=('stats', 'prune'), help='Show the cache size, or remove entries')
+    cache.add_argument('--max-size', type=float, default=None,
+                       help='With prune: remove the least recently used entries down to this many MB')
+    cache.add_argument('--max-age', type=float, default=None,
+                       help='With prune: remove the entries unused for this many days')
+
+    detect = subparser.add_parser('detect', help='Score images for signs of LSB steganography')
+    detect.add_argument('--image', required=True, nargs='+', help='Image paths or directories, scanned recursively')
+    detect.add_argument('--output', help='Report path, CSV or .jsonl (default: CSV on stdout)')
+    detect.add_argument('--format', choices=('csv', 'jsonl'), help='Report format (default: from the --output extension)')
+    detect.add_argument('--processes', type=int, default=None, help='Number of worker processes (default: all cores)')
+    detect.add_argument('--threshold', type=float, default=None,
+                        help='Exit with 1 when an image scores at least this much, from 0 to 1')
+
+    serve = subparser.add_parser('serve')
+    serve.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    serve.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    serve.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes (default: all cores)')
+    serve.add_argument('--max-pending', type=int, default=None,
+                       help='Requests running or queued before new ones get 503 (default: 4 per worker)')
+    serve.add_argument('--max-body', type=int, default=256 << 20, help='Largest accepted request body in bytes')
+    serve.add_argument('--backend', choices=Steganography.BACKENDS, default='numpy',
+                       help='Pixel kernels of the workers: numpy, or numba JIT')
 
     args = parser.parse_args()
 
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        run_command(parser, args)
+    finally:
+        total_seconds = time.perf_counter() - start
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.stats_json:
+            with open(args.stats_json, 'w') as file:
+                json.dump(stats.to_dict(total_seconds), file, indent=2)
+
+
+def _verify_text(image, key):
+    """Verify the text the Streamlit app hid in an image, importing its utils only then.
+
+    :param key: The key of the text, or None to only check its checksum.
+    :return: 'text', or None if the image holds no text header, and
+        VERIFIED, CORRUPT, WRONG_KEY or UNVERIFIED.
+    """
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'streamlit')
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    from utils import utils
+    pixels = np.asarray(image.convert('RGB'))
+    if utils.read_header(pixels) is None:
+        return None, UNVERIFIED
+    return 'text', utils.decode_with_status(pixels, key)[0]
+
+
+def _cached(cache, operation, inputs, params, output):
+    """ResultCache.cached, or a context that always misses when cache is None."""
+    return cache.cached(operation, inputs, params, output) if cache else nullcontext(False)
+
+
+@contextmanager
+def _reported_errors():
+    """Report the ValueError of an input the encoders refuse in one line on stderr, and exit with 1.
+
+    Such as a secret or payload that does not fit, or an output format that
+    would lose the merge record.
+    """
+    try:
+        yield
+    except ValueError as error:
+        print(f'Error: {error}', file=sys.stderr)
+        sys.exit(1)
+
+
+def run_command(parser, args):
+    """Run the subcommand parsed from the command line."""
+    if getattr(args, 'stream', False) and not args.output.lower().endswith('.png'):
+        parser.error('--stream writes PNG files, the output should end with .png')
+    if getattr(args, 'fit', 'pad') != 'pad' and (args.stream or is_raw(args.output)):
+        parser.error('--fit works on in-memory merges, not with --stream or raw outputs')
+    if args.command in ('merge', 'embed-file'):
+        try:
+            check_lossless(args.output)
+        except ValueError as error:
+            parser.error(str(error))
+    save_options = {'compress_level': getattr(args, 'compress_level', None),
+                    'optimize': getattr(args, 'optimize', False)}
+    steganography = Steganography(workers=getattr(args, 'workers', 1), backend=getattr(args, 'backend', 'numpy'))
+    if getattr(args, 'backend', 'numpy') != steganography.backend:
+        print('Numba is not installed, using the numpy backend', file=sys.stderr)
+
+    cache = ResultCache(args.cache_dir) if args.cache else None
+
     if args.command == 'merge':
-        coverImage = Image.open(args.coverImage)
-        secretImage = Image.open(args.secretImage)
-        Steganography().merge(coverImage, secretImage).save(args.output)
-        print(f"Saved encoded image to {args.output}")
+        params = {'bits': args.bits, 'stream': args.stream, 'strip_height': args.strip_height if args.stream else None,
+                  'fit': args.fit, **save_options}
+        inputs = [args.coverImage, args.secretImage]
+        with _reported_errors(), _cached(cache, 'merge', inputs, params, args.output) as hit:
+            if hit:
+                pass
+            elif is_raw(args.output) and not args.stream:
+                steganography.merge_mapped(args.coverImage, args.secretImage, args.output, bits=args.bits)
+            elif args.stream:
+                steganography.merge_stream(args.coverImage, args.secretImage, args.output,
+                                           strip_height=args.strip_height, bits=args.bits,
+                                           compress_level=args.compress_level)
+            else:
+                coverImage = open_image(args.coverImage)
+                secretImage = open_image(args.secretImage)
+                save_image(steganography.merge(coverImage, secretImage, bits=args.bits, fit=args.fit),
+                           args.output, **save_options)
+        print(f"Saved encoded image to {args.output}{' (cached)' if hit else ''}")
 
     elif args.command == 'unmerge':
-        image = Image.open(args.image)
-        Steganography().unmerge(image, compare=args.compare).save(args.output)
-        print(f"Saved decoded image to {args.output}")
+        params = {'bits': args.bits, 'stream': args.stream, 'strip_height': args.strip_height if args.stream else None,
+                  **save_options}
+        status = None
+        with _cached(cache, 'unmerge', [args.image], params, args.output) as hit:
+            if hit:
+                pass
+            elif is_raw(args.output) and not args.stream:
+                status = steganography.unmerge_mapped(args.image, args.output, bits=args.bits)[1]
+            elif args.stream:
+                status = steganography.unmerge_stream(args.image, args.output,
+                                                      strip_height=args.strip_height, bits=args.bits,
+                                                      compress_level=args.compress_level)
+            else:
+                decoded = steganography.unmerge(open_image(args.image), bits=args.bits)
+                status = decoded.info[STATUS_KEY]
+                save_image(decoded, args.output, **save_options)
+        if status == CORRUPT:
+            print(f'Warning: {args.image} does not match its checksum, the secret is damaged', file=sys.stderr)
+        if args.compare:
+            print()
+            print_metrics(Steganography().compare(open_image(args.output), open_image(args.compare)))
+            print()
+        print(f"Saved decoded image to {args.output}{' (cached)' if hit else ''}")
+
+    elif args.command == 'compare':
+        metrics = Steganography().compare(open_image(args.image), open_image(args.original),
+                                          per_channel=args.per_channel)
+        if args.json:
+            print(metrics_to_json(metrics))
+        else:
+            print_metrics(metrics)
+
+    elif args.command == 'embed-file':
+        params = {'bits': args.bits, **save_options}
+        inputs = [args.coverImage, args.payload]
+        with _reported_errors(), _cached(cache, 'embed-file', inputs, params, args.output) as hit:
+            if hit:
+                pass
+            elif is_raw(args.output):
+                Steganography().embed_file_mapped(args.coverImage, args.payload, args.output, bits=args.bits)
+            else:
+                coverImage = open_image(args.coverImage)
+                save_image(Steganography().embed_file(coverImage, args.payload, bits=args.bits), args.output,
+                           **save_options)
+        print(f"Saved encoded image to {args.output}{' (cached)' if hit else ''}")
+
+    elif args.command == 'extract-file':
+        with _reported_errors():
+            if is_raw(args.image):
+                size = Steganography().extract_file_mapped(args.image, args.output)
+            else:
+                size = Steganography().extract_file(open_image(args.image), args.output)
+        print(f"Saved {size} extracted bytes to {args.output}")
+
+    elif args.command == 'verify':
+        failed = 0
+        for path in args.image:
+            try:
+                image = open_image(path)
+                kind, status = Steganography().verify(image)
+                if kind is None:
+                    kind, status = _verify_text(image, args.key)
+            except (OSError, ValueError, Image.DecompressionBombError) as error:
+                print(f'{path}: error: {error}')
+                failed += 1
+                continue
+            print(f'{path}: {kind or "nothing hidden"} {status}')
+            if status in (CORRUPT, WRONG_KEY) or (args.strict and status == UNVERIFIED):
+                failed += 1
+        if failed:
+            sys.exit(1)
+
+    elif args.command == 'batch':
+        if args.manifest:
+            jobs = load_manifest(args.manifest)
+        elif args.covers and args.secrets and args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            jobs = directory_jobs(args.covers, args.secrets, args.output_dir)
+        else:
+            parser.error('batch needs --manifest, or --covers, --secrets and --output-dir')
+        if args.pipeline:
+            failed = run_pipeline(jobs, readers=args.readers, computers=args.compute_threads,
+                                  writers=args.writers, in_flight=args.in_flight, force=args.force)
+        else:
+            failed = run_batch(jobs, processes=args.processes, force=args.force)
+        if failed:
+            sys.exit(1)
+
+    elif args.command == 'cache':
+        cache = ResultCache(args.cache_dir)
+        if args.action == 'stats':
+            summary = cache.stats()
+            print(f'{summary["entries"]} entries, {summary["bytes"] / 1e6:.1f} MB in {summary["directory"]}')
+            if summary['entries']:
+                print(f'Last used {summary["newest_seconds"] / 3600:.1f} h ago (newest), '
+                      f'{summary["oldest_seconds"] / 3600:.1f} h ago (oldest)')
+        else:
+            max_bytes = int(args.max_size * 1e6) if args.max_size is not None else None
+            max_age = args.max_age * 24 * 3600 if args.max_age is not None else None
+            removed, removed_bytes = cache.prune(max_bytes=max_bytes, max_age=max_age)
+            print(f'Removed {removed} entries, {removed_bytes / 1e6:.1f} MB')
+
+    elif args.command == 'detect':
+        # Imported here so the other subcommands don't pay for the Streamlit utils
+        import steganalysis
+        report_format = args.format or ('jsonl' if (args.output or '').endswith('.jsonl') else 'csv')
+        flagged, scanned, start = 0, 0, time.perf_counter()
+        with open(args.output, 'w', newline='') if args.output else nullcontext(sys.stdout) as file:
+            writer = steganalysis.ReportWriter(file, report_format)
+            for row in steganalysis.scan(args.image, processes=args.processes):
+                writer.write(row)
+                scanned += 1
+                if args.threshold is not None and row['score'] is not None and row['score'] >= args.threshold:
+                    flagged += 1
+        elapsed = time.perf_counter() - start
+        print(f'Scanned {scanned} images in {elapsed:.1f} s ({scanned / elapsed * 60 if elapsed else 0:.0f}/min)'
+              + (f', {flagged} at or above {args.threshold}' if args.threshold is not None else ''), file=sys.stderr)
+        if flagged:
+            sys.exit(1)
+
+    elif args.command == 'serve':
+        # Imported here: the server imports this module and the Streamlit utilities
+        import server
+        server.serve(args.host, args.port, workers=args.workers, max_pending=args.max_pending,
+                     max_body=args.max_body, backend=steganography.backend)
+
 
 if __name__ == '__main__':
+    # utils, server and steganalysis import this module by name: share it, and its stats, with them
+    sys.modules.setdefault('steganography', sys.modules[__name__])
     main()
@@ -6,17 +6,76 @@ from utils.utils import (
     generateDownloadableImage,
     calculate_image_max_bytes,
     encode,
-    decode,
+    decode_with_status,
     encode_images,
     decode_image,
     generateDownloadableImageFromPilImage,
+    CORRUPT,
+    STATUS_KEY,
+    WRONG_KEY,
 )
 from io import BytesIO
+import hashlib
 
 st.set_page_config(
     page_title="Steganography",
 )
 
+# Results are cached by a hash of the uploaded bytes, so reruns triggered by
+# other widgets (like typing the key) never decode the same upload again.
+# Arguments starting with an underscore are not hashed by Streamlit.
+CACHE_ENTRIES = 16
+
+
+def upload_digest(uploaded):
+    return hashlib.sha256(uploaded.getvalue()).hexdigest()
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES)
+def cached_rgb(digest, _data):
+    return np.array(Image.open(BytesIO(_data)).convert('RGB'))
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES)
+def cached_max_bytes(digest, _data):
+    return calculate_image_max_bytes(BytesIO(_data))
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES)
+def cached_encode(digest, _data, secret_msg, key):
+    flag, encoded_image = encode(BytesIO(_data), secret_data=secret_msg, key=key)
+    return flag, generateDownloadableImage(encoded_image)
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES)
+def cached_decode(digest, _data, key):
+    return decode_with_status(cached_rgb(digest, _data), key)
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES)
+def cached_encode_images(container_digest, secret_digest, bits, fit, _container_data, _secret_data):
+    encoded_image = encode_images(Image.open(BytesIO(_container_data)), Image.open(BytesIO(_secret_data)),
+                                  bits=bits, fit=fit)
+    return generateDownloadableImageFromPilImage(encoded_image)
+
+
+class CorruptDecode(Exception):
+    # Streamlit does not cache a call that raises, so a corrupt decode is
+    # always redone and its status can never come back stale from the cache.
+    def __init__(self, result):
+        super().__init__(CORRUPT)
+        self.result = result
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES)
+def cached_decode_image(digest, _data):
+    decoded_image = decode_image(Image.open(BytesIO(_data)))
+    result = decoded_image.info[STATUS_KEY], generateDownloadableImageFromPilImage(decoded_image)
+    if result[0] == CORRUPT:
+        raise CorruptDecode(result)
+    return result
+
+
 # CSS part
 st.write(styles, unsafe_allow_html=True)
 
@@ -65,14 +124,16 @@ if nav_selection == "Encode Text":
         "Upload Your Image", type=['png'])
 
     if uploaded_image is not None:
-        st.image(uploaded_image, caption="Uploaded Image", use_column_width=True)
+        image_data = uploaded_image.getvalue()
+        image_digest = upload_digest(uploaded_image)
+        st.image(image_data, caption="Uploaded Image", use_column_width=True)
         st.session_state['stage'] = 'waiting'
         if st.session_state['mode'] == 'encode':
-            max_bytes = calculate_image_max_bytes(uploaded_image)
+            max_bytes = cached_max_bytes(image_digest, image_data)
             st.markdown(
                 f"<p class='info-text'>Max bytes to encode: {max_bytes}</p>", unsafe_allow_html=True)
 
-            if len(secret_msg) > max_bytes:
+            if len(secret_msg.encode("utf-8")) > max_bytes:
                 st.session_state['stage'] = 'Error'
                 st.markdown(
                     '<p class="info-text">Insufficient bytes, need bigger image or less data</p>', unsafe_allow_html=True)
@@ -85,12 +146,10 @@ if nav_selection == "Encode Text":
                 if len(key) > 0 and len(secret_msg) > 0:
                     process_logger.markdown(
                         "<p class='info-text'>Encoding...</p>", unsafe_allow_html=True)
-                    flag, encoded_image = encode(
-                        uploaded_image, secret_data=secret_msg, key=key)
+                    flag, byte_im = cached_encode(image_digest, image_data, secret_msg, key)
                     st.session_state['stage'] = flag
                     if st.session_state['stage'] == 'Encode-Done':
                         process_logger.write('')
-                        byte_im = generateDownloadableImage(encoded_image)
                         st.markdown(
                             "<p class='info-text'>&#9989;Your message has been successfully concealed within the image</p>", unsafe_allow_html=True)
                         st.download_button(
@@ -101,14 +160,16 @@ if nav_selection == "Encode Text":
                         )
             
             if st.session_state['mode'] == 'decode':
-                img = Image.open(uploaded_image)
-                img_numpy = np.array(img.convert('RGB'))
                 process_logger.markdown(
                     "<p class='info-text'>Decoding...</p>", unsafe_allow_html=True)
-                flag, decoded_data = decode(img_numpy, key)
-                st.session_state['stage'] = flag
-                if st.session_state['stage'] == 'Decode-Done':
-                    process_logger.write('')
+                status, decoded_data = cached_decode(image_digest, image_data, key)
+                st.session_state['stage'] = 'Decode-Done'
+                process_logger.write('')
+                if status == CORRUPT:
+                    st.error("The image is damaged: the hidden message does not match its checksum")
+                elif status == WRONG_KEY:
+                    st.error("Wrong Key :)")
+                else:
                     st.markdown(
                         f'<p class="info-text">Extracted Message: <b>{decoded_data}</b></p>', unsafe_allow_html=True)
 
@@ -142,20 +203,22 @@ elif nav_selection == "Encode Image":
             if uploaded_secret_image is not None:
                 st.image(uploaded_secret_image, caption="Secret Image", use_column_width=True)
 
+        bits = st.slider(
+            "Bits per channel for the secret image", min_value=1, max_value=7, value=4,
+            help="More bits keep more of the secret image but alter the container image more")
+        fit = st.radio(
+            "If the secret image is larger than the container", ['crop', 'resize'], horizontal=True,
+            help="Crop keeps the top-left corner at full resolution, resize scales the whole secret down")
+
         start_encoding = st.button("Start Encoding")
 
         if start_encoding:
             if uploaded_container_image is not None and uploaded_secret_image is not None:
-                container_image = Image.open(uploaded_container_image)
-                secret_image = Image.open(uploaded_secret_image)
-
-                encoded_image = encode_images(container_image, secret_image)
+                byte_im = cached_encode_images(
+                    upload_digest(uploaded_container_image), upload_digest(uploaded_secret_image), bits, fit,
+                    uploaded_container_image.getvalue(), uploaded_secret_image.getvalue())
             
-                st.image(encoded_image, caption="Encoded Image", use_column_width=True)
-
-                # Assuming `encoded_image` is a NumPy array
-                # byte_im = generateDownloadableImage(encoded_image)
-                byte_im = generateDownloadableImageFromPilImage(encoded_image)
+                st.image(byte_im, caption="Encoded Image", use_column_width=True)
 
                 # Use BytesIO to convert to bytes
                 byte_io = BytesIO(byte_im)
@@ -180,9 +243,14 @@ elif nav_selection == "Encode Image":
 
         if start_decoding:
             if uploaded_encoded_image is not None:
-                encoded_image = Image.open(uploaded_encoded_image)
-                decoded_image = decode_image(encoded_image)
+                try:
+                    status, decoded_image = cached_decode_image(
+                        upload_digest(uploaded_encoded_image), uploaded_encoded_image.getvalue())
+                except CorruptDecode as corrupt:
+                    status, decoded_image = corrupt.result
 
+                if status == CORRUPT:
+                    st.error("The image is damaged: the decoded image does not match its checksum")
                 st.image(decoded_image, caption="Decoded Image", use_column_width=True)
                 # byte_im = generateDownloadableImage(decoded_image)
                 # byte_io = BytesIO(byte_im)
@@ -1,19 +1,70 @@
-from PIL import Image
+from PIL import Image, PngImagePlugin
 from io import BytesIO
+import os
+from functools import lru_cache
 import numpy as np
+import struct
+import zlib
+from base64 import b64encode, b64decode
+import sys
+
+# The image format (header, text keys, secret fitting) belongs to the CLI in
+# the repository root; the app imports it so both write and read the same images
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from steganography import (BITS_KEY, CHECKSUM_KEY, CORRUPT, FIT_MODES, SECRET_SIZE_KEY, STATUS_KEY,  # noqa: E402,F401
+                           TEXT_KEYS, UNVERIFIED, VERIFIED, WRONG_KEY, Steganography, _numba_kernels, prepare_secret,
+                           stats)
+
+# cryptography and Numba are slow to import, so they are imported by the
+# functions using them: loading this module stays cheap for image-only use
 
 stop_at = "ggspit"
 
-def generateDownloadableImage(img):
+# Header written before the payload: magic, format version, flags, payload length
+# Version 1 payloads are base64 AES-ECB text; version 2 payloads are the
+# AES-GCM nonce and tag followed by the raw ciphertext; version 3 adds the
+# CRC32 of the ciphertext after the tag, which tells corruption from a wrong key
+HEADER_FORMAT = '>4sBBI'
+HEADER_MAGIC = b'GGST'
+HEADER_VERSION = 3
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+FLAG_ENCRYPTED = 1
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+CHECKSUM_FORMAT = '>I'
+CHECKSUM_SIZE = struct.calcsize(CHECKSUM_FORMAT)
+# Where the ciphertext starts, after the header, nonce, tag and checksum
+PAYLOAD_OFFSET = HEADER_SIZE + NONCE_SIZE + TAG_SIZE + CHECKSUM_SIZE
+
+# The outcome of a decode, as returned by `decode_with_status`, are the CLI's
+# VERIFIED (checksum and key both check out), CORRUPT (the payload no longer
+# matches its checksum), WRONG_KEY (the payload is intact but the key does not
+# open it) and UNVERIFIED (older formats without a checksum)
+AES_BLOCK_SIZE = 16
+# Bytes encrypted and embedded (or extracted and decrypted) at a time
+CHUNK_SIZE = 1 << 16
+
+def generateDownloadableImage(img, compress_level=6):
+    """PNG bytes of an RGB array; compress_level goes from 0 (fastest) to 9 (smallest)."""
     img = Image.fromarray(img)
     buf = BytesIO()
-    img.save(buf, format="png")
+    with stats.stage('save'):
+        img.save(buf, format="png", compress_level=compress_level)
     byte_im = buf.getvalue()
     return byte_im
 
-def generateDownloadableImageFromPilImage(img: Image):
+def generateDownloadableImageFromPilImage(img: Image, compress_level=6):
+    """PNG bytes of a PIL image, keeping the bits per channel, secret size and checksum recorded by `encode_images`."""
     buf = BytesIO()
-    img.save(buf, format="png")
+    pnginfo = PngImagePlugin.PngInfo()
+    for key in TEXT_KEYS:
+        if key in img.info:
+            pnginfo.add_text(key, img.info[key])
+    with stats.stage('save'):
+        img.save(buf, format="png", pnginfo=pnginfo, compress_level=compress_level)
     byte_im = buf.getvalue()
     return byte_im
 
@@ -88,16 +139,21 @@ def calculate_image_max_bytes(img):
         so we can calculate total bytes 345600 x 3 =  1, 036, 800 bytes
         and since 1byte = 8bit so we need to divide it by 8 and get the division floor
 
+        `encode` converts the image to RGB whatever its mode, so only the size matters,
+        and it is read from the header without decoding the pixels.
+        From those bytes we take off what `encode` adds to the message: the header,
+        the AES-GCM nonce and tag and the checksum. The ciphertext is as long as the message.
+
     Args:
         img (PIL Image Object): The Image
 
     Returns:
-        int: return max_bytes as Integer
+        int: return max_bytes as Integer, the longest message (in UTF-8 bytes) that fits
     """
-    img = Image.open(img)
-    img_numpy = np.array(img.convert('RGB'))
-    max_bytes = img_numpy.shape[0] * img_numpy.shape[1] * 3 // 8
-    return max_bytes
+    width, height = Image.open(img).size
+    image_bytes = width * height * 3 // 8
+    max_bytes = image_bytes - PAYLOAD_OFFSET
+    return max(max_bytes, 0)
 
 
 def encode(uploaded: object, secret_data: str, key: str):
@@ -115,132 +171,243 @@ def encode(uploaded: object, secret_data: str, key: str):
         img: returns a numpy ndarray
     """
     # read the uploaded image
-    img = Image.open(uploaded)
-    img = np.array(img.convert('RGB'))
-    # add stopping criteria using the defined key
-    secret_data = encrypt_text(secret_data, key)
-    secret_data += stop_at
-    data_index = 0
-    # convert data to binary
-    binary_secret_data = to_bin(secret_data)
-    # size of data to hide
-    data_len = len(binary_secret_data)
-
-    for row in img:
-        for pixel in row:
-            # convert RGB values to binary format
-            r, g, b = to_bin(pixel)
-            # modify the LSB(least significant bit) only if there is still data to store
-            if data_index < data_len:
-                # least significant red pixel bit
-                pixel[0] = int(r[:-1] + binary_secret_data[data_index], 2)
-                data_index += 1
-            if data_index < data_len:
-                # least significant green pixel bit
-                pixel[1] = int(g[:-1] + binary_secret_data[data_index], 2)
-                data_index += 1
-            if data_index < data_len:
-                # least significant blue pixel bit
-                pixel[2] = int(b[:-1] + binary_secret_data[data_index], 2)
-                data_index += 1
-            # if data is encoded, just break out of the loop
-            if data_index >= data_len:
-                break
+    with stats.stage('load'):
+        img = Image.open(uploaded)
+        img.load()
+    with stats.stage('convert'):
+        img = np.array(img.convert('RGB'))
+    data = secret_data.encode('utf-8')
+    if PAYLOAD_OFFSET + len(data) > img.size // 8:
+        raise ValueError('Insufficient bytes, need bigger image or less data')
+
+    # header, then the GCM nonce, tag and ciphertext checksum, then the raw ciphertext (no base64)
+    nonce = os.urandom(NONCE_SIZE)
+    header = struct.pack(HEADER_FORMAT, HEADER_MAGIC, HEADER_VERSION, FLAG_ENCRYPTED, len(data))
+    _embed_bytes(img, header + nonce)
+    encryptor = _aes(derive_key(key), 'GCM', nonce).encryptor()
+    offset = PAYLOAD_OFFSET
+    checksum = 0
+    for start in range(0, len(data), CHUNK_SIZE):
+        with stats.stage('encrypt'):
+            ciphertext = encryptor.update(data[start:start + CHUNK_SIZE])
+            checksum = zlib.crc32(ciphertext, checksum)
+        with stats.stage('embed'):
+            _embed_bytes(img, ciphertext, offset)
+        offset += len(ciphertext)
+    encryptor.finalize()
+    _embed_bytes(img, encryptor.tag + struct.pack(CHECKSUM_FORMAT, checksum), HEADER_SIZE + NONCE_SIZE)
     flag = 'Encode-Done'
     return flag, img
 
 
+BACKENDS = ('numpy', 'numba')
+
+# The LSB kernels in use, changed with set_backend
+backend = 'numpy'
+
+
+def set_backend(name):
+    """Select the LSB kernels: 'numpy', or 'numba' for JIT-compiled single-pass kernels.
+
+    Falls back to numpy when Numba is not installed.
+
+    Returns:
+        str: The backend in use.
+    """
+    global backend
+    if name not in BACKENDS:
+        raise ValueError(f'backend should be one of {", ".join(BACKENDS)}!')
+    backend = 'numba' if name == 'numba' and _numba_kernels() else 'numpy'
+    return backend
+
+
+def _embed_bytes(img, data, offset=0):
+    """Write `data` into the LSBs of `img` in place, starting at byte `offset`."""
+    # the channel values in row, pixel, (red, green, blue) order
+    channels = img.reshape(-1)[offset * 8:]
+    if len(data) * 8 > len(channels):
+        raise ValueError('Insufficient bytes, need bigger image or less data')
+    if backend == 'numba':
+        _numba_kernels().embed_kernel(channels, np.frombuffer(data, dtype=np.uint8))
+        return
+    # convert data to bits, one uint8 (0 or 1) per bit
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    # replace the LSB(least significant bit) of the first len(bits) channel values only
+    channels[:len(bits)] &= 0xFE
+    channels[:len(bits)] |= bits
+
+
+def _extract_bytes(img, offset, length):
+    """Read `length` bytes from the LSBs of `img`, starting at byte `offset`."""
+    channels = np.asarray(img).reshape(-1)
+    if backend == 'numba':
+        out = np.empty(len(channels[offset * 8:(offset + length) * 8]) // 8, dtype=np.uint8)
+        _numba_kernels().extract_kernel(channels[offset * 8:], out)
+        return out.tobytes()
+    bits = channels[offset * 8:(offset + length) * 8] & 1
+    return np.packbits(bits).tobytes()
+
+
+def _iter_extracted(img, offset, length):
+    """Read `length` bytes from the LSBs of `img` in chunks of at most CHUNK_SIZE bytes."""
+    for start in range(offset, offset + length, CHUNK_SIZE):
+        yield _extract_bytes(img, start, min(CHUNK_SIZE, offset + length - start))
+
+
 def decode(encoded_img, key):
-    binary_data = ""
-    for row in encoded_img:
-        for pixel in row:
-            r, g, b = pixel
-            r, g, b = to_bin(pixel)
-            binary_data += r[-1]
-            binary_data += g[-1]
-            binary_data += b[-1]
-    # split by 8-bits
-    all_bytes = [binary_data[i: i+8] for i in range(0, len(binary_data), 8)]
-    # convert from bits to characters
-    decoded_data = ""
-    for byte in all_bytes:
-        decoded_data += chr(int(byte, 2))
-        if decoded_data[-len(key):] == key:
-            break
-    flag = 'Decode-Done'
-    decodedText = decrypt_text(decoded_data[:-len(key)], key)
-    return flag, decodedText
+    """
+    Args:
+        encoded_img (np array): the RGB image returned by `encode`
+        key (str): the key the message was encoded with
 
-BLACK_PIXEL = (0, 0, 0)
+    Returns:
+        flag, decodedText: 'Decode-Done' and the decrypted message, or a
+        message saying the key is wrong or the image is corrupt
+    """
+    status, decodedText = decode_with_status(encoded_img, key)
+    if status == WRONG_KEY:
+        decodedText = "Wrong Key :)"
+    elif status == CORRUPT:
+        decodedText = "Corrupted Image :("
+    return 'Decode-Done', decodedText
 
-def encode_images(container_image, secret_image):
-    coverImage = container_image
-    secretImage = secret_image
-    secret_image = secret_image.resize(container_image.size)
 
-    # if secretImage.size[0] > coverImage.size[0] or secretImage.size[1] > coverImage.size[1]:
-    #     raise ValueError('Secret image should be smaller than cover!')
+def read_header(encoded_img):
+    """
+    Args:
+        encoded_img (np array): an RGB image
 
-    map1 = coverImage.load()
-    map2 = secretImage.load()
+    Returns:
+        The (version, flags, payload length) of the header `encode` wrote, or None
+        if the image has none or is too small to hold one
+    """
+    if np.asarray(encoded_img).size < HEADER_SIZE * 8:
+        return None
+    magic, version, flags, length = struct.unpack(HEADER_FORMAT, _extract_bytes(encoded_img, 0, HEADER_SIZE))
+    if magic != HEADER_MAGIC or version not in (1, 2, HEADER_VERSION):
+        return None
+    return version, flags, length
 
-    new_image = Image.new(coverImage.mode, coverImage.size)
-    new_map = new_image.load()
 
-    for i in range(coverImage.size[0]):
-        for j in range(coverImage.size[1]):
-            is_valid = lambda: i < secretImage.size[0] and j < secretImage.size[1]
-            rgb1 = map1[i ,j]
-            rgb2 = map2[i, j] if is_valid() else BLACK_PIXEL
-            new_map[i, j] = merge_rgb(rgb1, rgb2)
-    return new_image
+def decode_with_status(encoded_img, key):
+    """Decode the message and say whether it could be verified.
 
-    # container_np = np.array(container_image.convert('RGB'))
-    # secret_np = np.array(secret_image.convert('RGB'))
+    The checksum of version 3 payloads is checked before decrypting, so a
+    damaged image is reported as CORRUPT, and an intact one the key fails to
+    open as WRONG_KEY. Older payloads can't tell the two apart: a failed
+    decryption is reported as WRONG_KEY, and payloads without a header as
+    UNVERIFIED.
 
-    # for i in range(container_np.shape[0]):
-    #     for j in range(container_np.shape[1]):
-    #         for c in range(3):  # Iterate over RGB channels
-    #             container_np[i, j, c] = (container_np[i, j, c] & 0xFE) | (secret_np[i, j, c] >> 7)
+    Args:
+        encoded_img (np array): the RGB image returned by `encode`
+        key (str): the key the message was encoded with, or None to only check the
+            checksum (the text is then empty)
 
-    # return container_np
+    Returns:
+        status, decodedText: one of VERIFIED, CORRUPT, WRONG_KEY or UNVERIFIED, and
+        the decrypted message ('' unless VERIFIED or UNVERIFIED)
+    """
+    from cryptography.exceptions import InvalidTag
+
+    header = read_header(encoded_img)
+    if header is None:
+        return UNVERIFIED, _decode_legacy(encoded_img, key)[1] if key is not None else ''
+    version, flags, length = header
+    if version == 1:
+        # base64 of the AES-ECB ciphertext
+        payload = _extract_bytes(encoded_img, HEADER_SIZE, length).decode('ascii', errors='replace')
+        return UNVERIFIED, decrypt_text(payload, key) if key is not None else ''
+
+    offset = HEADER_SIZE + NONCE_SIZE + TAG_SIZE
+    expected = None
+    if version == HEADER_VERSION:
+        expected, = struct.unpack(CHECKSUM_FORMAT, _extract_bytes(encoded_img, offset, CHECKSUM_SIZE))
+        offset += CHECKSUM_SIZE
+    if offset + length > np.asarray(encoded_img).size // 8:
+        return CORRUPT, ''
+
+    nonce_and_tag = _extract_bytes(encoded_img, HEADER_SIZE, NONCE_SIZE + TAG_SIZE)
+    nonce, tag = nonce_and_tag[:NONCE_SIZE], nonce_and_tag[NONCE_SIZE:]
+    if expected is not None:
+        # check the checksum first, in one pass, so a corrupt image costs no decryption
+        checksum = 0
+        with stats.stage('verify'):
+            for chunk in _iter_extracted(encoded_img, offset, length):
+                checksum = zlib.crc32(chunk, checksum)
+        if checksum != expected:
+            return CORRUPT, ''
+    if key is None:
+        return VERIFIED if expected is not None else UNVERIFIED, ''
+
+    decryptor = _aes(derive_key(key), 'GCM', nonce, tag).decryptor()
+    # decrypt while extracting, reading exactly the payload the header announces
+    parts = []
+    chunks = _iter_extracted(encoded_img, offset, length)
+    while True:
+        with stats.stage('extract'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        with stats.stage('decrypt'):
+            parts.append(decryptor.update(chunk))
+    try:
+        decryptor.finalize()
+        return VERIFIED, b''.join(parts).decode('utf-8')
+    except InvalidTag:
+        return WRONG_KEY, ''
+    except UnicodeDecodeError:
+        return CORRUPT, ''
+
+
+def _decode_legacy(encoded_img, key):
+    """Decode an image written before the header existed, where the payload ends with `stop_at`."""
+    channels = np.asarray(encoded_img).reshape(-1)
+    data = _extract_bytes(encoded_img, 0, len(channels) // 8)
+    end = data.find(stop_at.encode('ascii'))
+    if end != -1:
+        data = data[:end]
+    flag = 'Decode-Done'
+    decodedText = decrypt_text(data.decode('latin-1'), key)
+    return flag, decodedText
 
+def encode_images(container_image, secret_image, bits=4, fit='crop'):
+    """Hide `secret_image` in the low `bits` bits of each channel of `container_image`.
 
-def decode_image(encoded_image):
-    image = encoded_image
-    pixel_map = image.load()
+    This is `Steganography.merge` from the CLI, with the secret cropped to the
+    container by default. The secret is placed in the top-left corner after
+    `prepare_secret` fitted it to the container, and the rest of the container
+    is black. The original secret size is recorded in the image info, and the
+    embedded size, `bits` and the CRC32 of the secret in an image header and in
+    the info, so `decode_image` only extracts the secret and can verify it.
+    """
+    return Steganography().merge(container_image, secret_image, bits=bits, fit=fit)
 
-    # Create the new image and load the pixel map
-    new_image = Image.new(image.mode, image.size)
-    new_map = new_image.load()
 
-    for i in range(image.size[0]):
-        for j in range(image.size[1]):
-            decoded_pixel = _unmerge_rgb(pixel_map[i, j])
-            new_map[i, j] = decoded_pixel
-    return new_image
+def decode_image(encoded_image, bits=None):
+    """Extract the image hidden by `encode_images`, like `Steganography.unmerge` in the CLI.
 
-    # width, height = encoded_image.size
-    # decoded_np = np.zeros((height, width, 3), dtype=np.uint8)
+    The output is cropped to the secret when its size was recorded. `bits`
+    defaults to the value recorded in the image, or 4. The output's
+    info[STATUS_KEY] says whether it matches the recorded checksum: VERIFIED or
+    CORRUPT, or UNVERIFIED if there is none or `bits` differs from the recorded bits.
+    """
+    return Steganography().unmerge(encoded_image, bits=bits)
 
-    # for i in range(height):
-    #     for j in range(width):
-    #         pixel_value = list(encoded_image.getpixel((j, i)))
-    #         for c in range(3):  # Iterate over RGB channels
-    #             pixel_value[c] = (pixel_value[c] & 1) * 255
-    #         decoded_np[i, j, :] = pixel_value
 
-    # decoded_image = Image.fromarray(decoded_np.astype('uint8'), 'RGB')
-    # return decoded_image
+def _aes(key, mode, *mode_args):
+    """An AES Cipher in the named cryptography mode, like _aes(key, 'GCM', nonce)."""
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    return Cipher(algorithms.AES(key), getattr(modes, mode)(*mode_args), backend=default_backend())
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.hkdf import HKDF
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from base64 import b64encode, b64decode
 
+@lru_cache(maxsize=128)
 def derive_key(key_material):
-    # Derive a 256-bit key using HKDF
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    # Derive a 256-bit key using HKDF, cached so repeated decodes reuse it
     hkdf = HKDF(
         algorithm=hashes.SHA256(),
         length=32,  # AES-256 key size
@@ -252,9 +419,10 @@ def derive_key(key_material):
     return key
 
 def pad_text(text):
-    block_size = algorithms.AES.block_size // 8
+    block_size = AES_BLOCK_SIZE
+    text = text.encode('utf-8')
     padding = block_size - (len(text) % block_size)
-    return text.encode('utf-8') + bytes([padding] * padding)
+    return text + bytes([padding] * padding)
 
 def unpad_text(padded_text):
     padding = padded_text[-1]
@@ -262,7 +430,7 @@ def unpad_text(padded_text):
 
 def encrypt_text(text, key):
     key = derive_key(key)
-    cipher = Cipher(algorithms.AES(key), modes.ECB(), backend=default_backend())
+    cipher = _aes(key, 'ECB')
     encryptor = cipher.encryptor()
     padded_text = pad_text(text)
     ciphertext = encryptor.update(padded_text) + encryptor.finalize()
@@ -271,7 +439,7 @@ def encrypt_text(text, key):
 def decrypt_text(encrypted_text, key):
     try:
         key = derive_key(key)
-        cipher = Cipher(algorithms.AES(key), modes.ECB(), backend=default_backend())
+        cipher = _aes(key, 'ECB')
         decryptor = cipher.decryptor()
         ciphertext = b64decode(encrypted_text)
         decrypted_text = decryptor.update(ciphertext) + decryptor.finalize()
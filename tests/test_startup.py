@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+
+
+def test_startup_within_budget():
+    for result in benchmark.startup(repeat=3):
+        assert result['seconds'] <= result['budget_seconds'], result
+
+
+def test_import_steganography_leaves_slow_modules_unimported():
+    # A new interpreter: this one may have imported them for other tests
+    code = f'import sys, steganography; print(*[m for m in {benchmark.LAZY_MODULES!r} if m in sys.modules])'
+    result = subprocess.run([sys.executable, '-c', code], cwd=benchmark.ROOT, capture_output=True, text=True,
+                            check=True)
+    assert result.stdout.split() == []
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from steganography import VERIFIED, Steganography, open_image, save_image  # noqa: E402
+
+
+def _save_random(path, width, height, seed):
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    Image.fromarray(pixels).save(path)
+    return str(path)
+
+
+def test_stream_round_trip_verifies(tmp_path):
+    cover = _save_random(tmp_path / 'cover.png', 400, 300, 0)
+    secret = _save_random(tmp_path / 'secret.png', 300, 200, 1)
+    merged, unmerged = str(tmp_path / 'merged.png'), str(tmp_path / 'unmerged.png')
+    steganography = Steganography()
+    steganography.merge_stream(cover, secret, merged, strip_height=64)
+
+    assert steganography.unmerge_stream(merged, unmerged, strip_height=64) == VERIFIED
+    assert Image.open(unmerged).size == (300, 200)
+
+
+def test_stream_merge_matches_in_memory_merge(tmp_path):
+    cover = _save_random(tmp_path / 'cover.png', 100, 100, 2)
+    secret = _save_random(tmp_path / 'secret.png', 60, 90, 3)
+    expected = str(tmp_path / 'expected.png')
+    save_image(Steganography().merge(open_image(cover), open_image(secret)), expected)
+
+    # The last strip (rows 85-99) is shorter than the secret
+    for strip_height in (17, 100):
+        merged = str(tmp_path / f'merged-{strip_height}.png')
+        Steganography().merge_stream(cover, secret, merged, strip_height=strip_height)
+        np.testing.assert_array_equal(np.asarray(Image.open(merged)), np.asarray(Image.open(expected)))
@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'streamlit'))
+
+from utils import utils  # noqa: E402
+
+
+def test_read_header_of_a_tiny_image():
+    assert utils.read_header(np.zeros((5, 5, 3), dtype=np.uint8)) is None
+
+
+def test_verify_reports_unreadable_files_and_goes_on(tmp_path):
+    tiny, junk = str(tmp_path / 'tiny.png'), str(tmp_path / 'junk.png')
+    Image.new('RGB', (5, 5)).save(tiny)
+    with open(junk, 'w') as file:
+        file.write('not an image')
+    missing = str(tmp_path / 'missing.png')
+
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'steganography.py'), 'verify',
+                             '--image', missing, junk, tiny], capture_output=True, text=True)
+
+    lines = result.stdout.splitlines()
+    assert result.returncode == 1
+    assert lines[0].startswith(f'{missing}: error: ')
+    assert lines[1].startswith(f'{junk}: error: ')
+    assert lines[2] == f'{tiny}: nothing hidden unverified'